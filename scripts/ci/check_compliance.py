@@ -6,12 +6,24 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
+import bisect
 import collections
+import copy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
 from email.utils import parseaddr
+import fnmatch
+import hashlib
+import importlib.metadata
+import importlib.util
+import io
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 from pathlib import Path
+import pickle
 import platform
 import re
 import subprocess
@@ -20,19 +32,175 @@ import tempfile
 import traceback
 import shlex
 import shutil
+import socket
 import textwrap
+import threading
+import time
 import unidiff
+import yaml
 
 from yamllint import config, linter
 
-from junitparser import TestCase, TestSuite, JUnitXml, Skipped, Error, Failure
-import magic
+from junitparser import TestCase, TestSuite, JUnitXml, Skipped, Error, Failure, \
+    Properties, Property
 
 from west.manifest import Manifest
 from west.manifest import ManifestProject
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
 logger = None
 
+
+class CheckProfile:
+    """
+    Resources used while running a test, see run_test(). Used as a context
+    manager around the test's run() method. Subprocesses are accounted for in
+    the profile of the test that runs them, via run_subprocess().
+
+    wall_time:
+      Wall-clock time in seconds
+
+    cpu_time:
+      CPU time in seconds used by the thread running the test, not including
+      subprocesses
+
+    max_rss:
+      Peak resident set size in kB of the process running the test, as of the
+      end of the test, or None if unknown. Tests running in parallel threads
+      share the process, so this is an upper bound for the test.
+
+    subprocesses:
+      Number of subprocesses run
+
+    subprocess_time:
+      Total wall-clock time in seconds spent waiting for subprocesses
+
+    bytes_read:
+      Bytes read (from files, pipes, ...) by the thread running the test, or
+      None if unknown. Only available on Linux.
+    """
+    _current = threading.local()
+
+    def __init__(self):
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.max_rss = None
+        self.subprocesses = 0
+        self.subprocess_time = 0.0
+        self.bytes_read = None
+
+    @classmethod
+    def current(cls):
+        """
+        Returns the profile of the test running in the current thread, or None.
+        """
+        return getattr(cls._current, "profile", None)
+
+    def add_subprocess(self, duration):
+        """
+        Accounts for a subprocess that took 'duration' seconds.
+        """
+        self.subprocesses += 1
+        self.subprocess_time += duration
+
+    @staticmethod
+    def _thread_bytes_read():
+        # Returns the number of bytes read by the current thread, or None if
+        # unknown
+
+        try:
+            with open("/proc/thread-self/io") as f:
+                for line in f:
+                    if line.startswith("rchar:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def __enter__(self):
+        self._start = (time.perf_counter(), time.thread_time(),
+                       self._thread_bytes_read())
+        self._current.profile = self
+        return self
+
+    def __exit__(self, *exc):
+        self._current.profile = None
+
+        wall, cpu, bytes_read = self._start
+        self.wall_time = time.perf_counter() - wall
+        self.cpu_time = time.thread_time() - cpu
+        if bytes_read is not None:
+            self.bytes_read = self._thread_bytes_read() - bytes_read
+        if resource:
+            self.max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def as_dict(self):
+        """
+        Returns the profile as a dict, e.g. for JSON output.
+        """
+        return {"wall_time": round(self.wall_time, 3),
+                "cpu_time": round(self.cpu_time, 3),
+                "max_rss": self.max_rss,
+                "subprocesses": self.subprocesses,
+                "subprocess_time": round(self.subprocess_time, 3),
+                "bytes_read": self.bytes_read}
+
+    @classmethod
+    def from_dict(cls, profile_dict):
+        """
+        Creates a profile from an as_dict() dict.
+        """
+        profile = cls()
+        profile.__dict__.update(profile_dict)
+        return profile
+
+    def add_properties(self, case):
+        """
+        Adds the profile to the JUnit TestCase 'case', as <properties> and as
+        the 'time' attribute.
+        """
+        case.time = round(self.wall_time, 3)
+
+        props = Properties()
+        for name, value in self.as_dict().items():
+            if value is not None:
+                props.add_property(Property(f"profile.{name}", str(value)))
+        case.append(props)
+
+
+def run_subprocess(*args, **kwargs):
+    # Wrapper around subprocess.run() that accounts for the subprocess in the
+    # profile of the running test. Takes the same arguments.
+
+    profile = CheckProfile.current()
+    start = time.perf_counter()
+    try:
+        return subprocess.run(*args, **kwargs)
+    finally:
+        if profile:
+            profile.add_subprocess(time.perf_counter() - start)
+
+
+# Serializes changes to sys.path, see add_sys_path()
+SYS_PATH_LOCK = threading.Lock()
+
+
+def add_sys_path(path):
+    # Puts 'path' first in sys.path, for importing modules from it, unless it
+    # is in sys.path already. Tests that aren't isolated can call this while
+    # running in parallel, and tests run many times by a --serve daemon don't
+    # make sys.path grow.
+
+    with SYS_PATH_LOCK:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
 def git(*args, cwd=None, ignore_non_zero=False):
     # Helper for running a Git command. Returns the rstrip()ed stdout output.
     # Called like git("diff"). Exits with SystemError (raised by sys.exit()) on
@@ -41,7 +209,7 @@ def git(*args, cwd=None, ignore_non_zero=False):
 
     git_cmd = ("git",) + args
     try:
-        cp = subprocess.run(git_cmd, capture_output=True, cwd=cwd)
+        cp = run_subprocess(git_cmd, capture_output=True, cwd=cwd)
     except OSError as e:
         err(f"failed to run '{cmd2str(git_cmd)}': {e}")
 
@@ -66,15 +234,810 @@ def get_shas(refspec):
                f'--max-count={-1 if "." in refspec else 1}', refspec).split()
 
 def get_files(filter=None, paths=None):
-    filter_arg = (f'--diff-filter={filter}',) if filter else ()
-    paths_arg = ('--', *paths) if paths else ()
-    out = git('diff', '--name-only', *filter_arg, COMMIT_RANGE, *paths_arg)
-    files = out.splitlines()
-    for file in list(files):
-        if not os.path.isfile(os.path.join(GIT_TOP, file)):
-            # Drop submodule directories from the list.
-            files.remove(file)
-    return files
+    return REPO.files(filter, paths)
+
+# A commit in the commit range, as parsed by iter_commits(). 'author' is
+# "<name> <<email>>", 'signed_off_by' a tuple with the values of all
+# Signed-off-by lines in the commit message, and 'check' the 'git diff
+# --check' output for the commit's changes.
+Commit = collections.namedtuple("Commit", "sha author body signed_off_by check")
+
+def iter_commits(refspec):
+    """
+    Generates a Commit for each commit in 'refspec' (for a single commit if
+    'refspec' isn't a range, like get_shas()).
+
+    All commits are read from a single 'git log --check' process, and parsed
+    while its output is streamed.
+    """
+    # Each commit starts with a header made of \x01-prefixed, \x02-separated
+    # fields, terminated by a null byte (-z). The --check output of the commit
+    # follows the header.
+    fmt = "%x01%H%x02%aN <%aE>%x02%B%x02"
+    git_cmd = ("git", "log", "-z", "--check", "--no-color", f"--format={fmt}",
+               f'--max-count={-1 if "." in refspec else 1}', refspec)
+
+    profile = CheckProfile.current()
+    start = time.perf_counter()
+    try:
+        proc = subprocess.Popen(git_cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=GIT_TOP)
+    except OSError as e:
+        err(f"failed to run '{cmd2str(git_cmd)}': {e}")
+
+    # Start of a commit header (at the start of the output or of a line)
+    start_re = re.compile(rb"(?<![^\n\0])\x01(?=[0-9a-f]+\x02)")
+
+    with proc:
+        buf = b""
+        while True:
+            chunk = proc.stdout.read(1 << 16)
+            buf += chunk
+
+            starts = [m.start() for m in start_re.finditer(buf)]
+            # The last commit in the buffer is only complete at EOF
+            ends = starts[1:] + ([len(buf)] if not chunk else [])
+            for commit_start, commit_end in zip(starts, ends):
+                yield _parse_commit(buf[commit_start:commit_end])
+            if ends:
+                buf = buf[ends[-1]:]
+
+            if not chunk:
+                break
+
+        stderr = proc.stderr.read()
+
+    if profile:
+        profile.add_subprocess(time.perf_counter() - start)
+
+    # --check makes 'git log' exit with status 2 if it finds problems
+    if proc.returncode not in (0, 2) or stderr:
+        err(f"'{cmd2str(git_cmd)}' exited with status {proc.returncode} and/or "
+            f"wrote to stderr.\n"
+            f"==stderr==\n"
+            f"{stderr.decode('utf-8')}\n")
+
+def _parse_commit(record):
+    # Parses a single commit from the 'git log' output in iter_commits()
+
+    header, _, check = record.partition(b"\0")
+    sha, author, body, _ = header[1:].decode("utf-8", "replace").split("\x02")
+    signed_off_by = tuple(re.findall(r"signed-off-by:\s(.*)", body,
+                                     re.IGNORECASE))
+
+    return Commit(sha, author, body, signed_off_by,
+                  check.decode("utf-8", "replace").strip("\n"))
+
+# (<signature>, <MIME type>) tuples for the image formats sniff_mime()
+# recognizes
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"II*\0", "image/tiff"),
+    (b"MM\0*", "image/tiff"),
+    (b"\0\0\1\0", "image/vnd.microsoft.icon"),
+)
+
+# Control characters that libmagic doesn't expect in text files
+CONTROL_CHARS_RE = re.compile(rb"[\x00-\x08\x0e-\x1a\x1c-\x1f]")
+
+
+def sniff_mime(data):
+    # Returns the MIME type and encoding of 'data' in the format libmagic
+    # uses, e.g. "text/plain; charset=us-ascii", or None if it can't be told
+    # cheaply. Images are recognized by their signature, Python scripts by
+    # their shebang line, and text by being valid ASCII or UTF-8. Other data,
+    # e.g. text in other encodings or markup like SVG images, is left to
+    # libmagic.
+
+    if not data:
+        return "application/x-empty; charset=binary"
+
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return f"{mime_type}; charset=binary"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp; charset=binary"
+
+    if CONTROL_CHARS_RE.search(data) or data.lstrip().startswith(b"<"):
+        return None
+
+    if data.isascii():
+        charset = "us-ascii"
+    else:
+        try:
+            data.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+        charset = "utf-8"
+
+    first_line = data.split(b"\n", 1)[0]
+    if first_line.startswith(b"#!") and b"python" in first_line:
+        return f"text/x-python; charset={charset}"
+    return f"text/plain; charset={charset}"
+
+
+def git_blob_id(data):
+    # Returns the Git blob ID (SHA-1) of a file with the contents 'data'
+
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def range_tip(commit_range):
+    # Returns the SHA of the last commit in 'commit_range', e.g. of HEAD for
+    # "HEAD~3.." and of v1.1 for "v1.0..v1.1" or "v1.1"
+
+    tip = commit_range
+    if ".." in commit_range:
+        tip = commit_range.rsplit("..", 1)[1].lstrip(".") or "HEAD"
+    return git("rev-parse", "--verify", f"{tip}^{{commit}}")
+
+
+class BlobReader:
+    """
+    Reads objects from the Git object store through a single long-lived
+    'git cat-file --batch' process, which is started on first use. Objects
+    can be read from tests running in parallel.
+    """
+    def __init__(self, cwd):
+        self._cwd = cwd
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def read(self, obj):
+        """
+        Returns a (<type>, <contents>) tuple for the object 'obj', e.g.
+        "HEAD:README.rst", or None if there's no such object. <type> is
+        "blob" for files, and e.g. "commit" for submodules.
+        """
+        with self._lock:
+            if self._proc is None:
+                git_cmd = ("git", "cat-file", "--batch")
+                try:
+                    self._proc = subprocess.Popen(git_cmd,
+                                                  stdin=subprocess.PIPE,
+                                                  stdout=subprocess.PIPE,
+                                                  cwd=self._cwd)
+                except OSError as e:
+                    err(f"failed to run '{cmd2str(git_cmd)}': {e}")
+
+            self._proc.stdin.write(obj.encode("utf-8") + b"\n")
+            self._proc.stdin.flush()
+
+            header = self._proc.stdout.readline()
+            if not header:
+                err(f"'git cat-file --batch' exited while reading {obj}")
+            if header.endswith((b" missing\n", b" ambiguous\n")):
+                return None
+
+            # <sha> <type> <size>, followed by the contents and a newline
+            _, typ, size = header.decode("utf-8").split()
+            contents = self._proc.stdout.read(int(size))
+            self._proc.stdout.read(1)
+            return typ, contents
+
+    def close(self):
+        """
+        Stops the 'git cat-file' process.
+        """
+        with self._lock:
+            if self._proc is not None:
+                self._proc.stdin.close()
+                self._proc.wait()
+                self._proc.stdout.close()
+                self._proc = None
+
+
+class LRUCache:
+    """
+    Mapping with a bound on the total size (len()) of its values. The least
+    recently used entries are dropped first when the bound is exceeded.
+    Values larger than the bound aren't cached. Not thread-safe.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._size = 0
+        self._entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def __setitem__(self, key, value):
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+        if len(value) > self.max_size:
+            return
+
+        self._entries[key] = value
+        self._size += len(value)
+        while self._size > self.max_size:
+            _, old = self._entries.popitem(last=False)
+            self._size -= len(old)
+
+
+# A file changed in the commit range, as parsed from the diff by
+# RepoSnapshot.changes(). 'status' is "A" (added), "D" (deleted), "R"
+# (renamed) or "M" (modified), and 'binary' is True for binary files.
+# 'added_lines' is a frozenset with the numbers of the lines added to the file
+# (in the new version of the file), and 'added_ranges' a tuple with the same
+# lines as (<first>, <last>) ranges, in order.
+FileChange = collections.namedtuple(
+    "FileChange", "path status binary added_lines added_ranges")
+
+class RepoSnapshot:
+    """
+    Run-scoped view of the Git repository for the commit range being checked.
+    With --staged and --worktree, the changes in the index or in the working
+    tree are checked instead (see 'diff_args').
+
+    Each Git query is run once, the first time a test needs it, and the
+    result is shared by all tests of the run. The same goes for the contents
+    and MIME types of files, so that each file is only read and sniffed once.
+    Queries are serialized with a lock, so the snapshot can be used from tests
+    running in parallel (--jobs). Snapshots can be pickled, e.g. to be handed
+    to a worker process, and keep the results computed so far, except for
+    file contents and the diff.
+
+    File contents are read from the Git object store at 'tip', so that e.g.
+    changes in the working tree don't affect the checks. They are kept in an
+    LRU cache of MAX_CONTENTS_SIZE bytes (characters for text). Symbolic links
+    are followed like on the file system, see _resolve().
+
+    The diff is generated and parsed once per run. Tests look at it through
+    changes(), which describes each changed file, and diff().
+    """
+    MAX_CONTENTS_SIZE = 64 << 20
+
+    # Maximum number of symbolic links followed when resolving a path, like
+    # the ELOOP limit of the file system
+    MAX_SYMLINKS = 40
+
+    # Maximum number of paths looked up per 'git ls-tree' or 'git ls-files'
+    # command
+    MAX_LOOKUP_PATHS = 512
+
+    def __init__(self, commit_range, diff_args=None, tip=None):
+        """
+        'diff_args' are the 'git diff' arguments that select the changes to
+        check. They default to 'commit_range'. Commits are always taken from
+        'commit_range'.
+
+        'tip' is the revision to read files from: a commit, "" for the index,
+        or None for the working tree.
+        """
+        self.commit_range = commit_range
+        self.diff_args = diff_args or (commit_range,)
+        self.tip = tip
+        self._cache = {}
+        self._isfile = {}
+        self._entries = {}
+        self._contents = LRUCache(self.MAX_CONTENTS_SIZE)
+        self._blobs = None
+        self._magic = None
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        with self._lock:
+            state = self.__dict__.copy()
+            # The diff can be large, and is cheap to generate again
+            state["_cache"] = {key: value for key, value in self._cache.items()
+                               if key not in (("diff",), ("patchset",))}
+            state["_isfile"] = self._isfile.copy()
+            state["_entries"] = self._entries.copy()
+        state["_contents"] = LRUCache(self.MAX_CONTENTS_SIZE)
+        state["_blobs"] = None
+        state["_magic"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _cached(self, key, fn):
+        # Returns the cached result for 'key', calling fn() to compute it on
+        # first use
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = fn()
+            return self._cache[key]
+
+    def close(self):
+        """
+        Stops the 'git cat-file' process used to read files, if any. The
+        snapshot can still be used afterwards.
+        """
+        with self._lock:
+            if self._blobs is not None:
+                self._blobs.close()
+
+    def _lookup(self, paths):
+        # Looks up the tree entries for 'paths' at 'tip' (in the index if
+        # 'tip' is "") that aren't known yet, and records them in
+        # self._entries as (<mode>, <object ID>) tuples. <mode> is e.g.
+        # "100644" for regular files, "120000" for symbolic links, and
+        # "040000" for directories, whose object ID is None in the index.
+        # Missing paths are recorded as None.
+
+        with self._lock:
+            paths = [path for path in dict.fromkeys(paths)
+                     if path not in self._entries]
+
+            for i in range(0, len(paths), self.MAX_LOOKUP_PATHS):
+                chunk = paths[i:i + self.MAX_LOOKUP_PATHS]
+                if self.tip:
+                    # <mode> SP <type> SP <object> TAB <path>
+                    out = git('--literal-pathspecs', 'ls-tree', '-z',
+                              '--full-tree', self.tip, '--', *chunk,
+                              cwd=GIT_TOP)
+                else:
+                    # <mode> SP <object> SP <stage> TAB <path>
+                    out = git('--literal-pathspecs', 'ls-files', '-s', '-z',
+                              '--', *chunk, cwd=GIT_TOP)
+
+                found = {}
+                for record in out.split("\0"):
+                    if record:
+                        info, path = record.split("\t", 1)
+                        fields = info.split()
+                        found[path] = (fields[0],
+                                       fields[2 if self.tip else 1])
+
+                for path in chunk:
+                    entry = found.get(path)
+                    # Directories show up as the files in them if another
+                    # path in the command is within them, and always in the
+                    # index
+                    if entry is None and \
+                       any(found_path.startswith(path + "/")
+                           for found_path in found):
+                        entry = ("040000", None)
+                    self._entries[path] = entry
+
+    def _resolve(self, file):
+        # Returns the object ID of the regular file that 'file' refers to at
+        # 'tip', or None if there's no such file. Symbolic links (in 'file'
+        # or in the directories leading to it) are followed like on the file
+        # system. Links that point outside of the repository are treated as
+        # missing, since their targets aren't part of the snapshot.
+
+        with self._lock:
+            self._lookup((file,))
+            entry = self._entries[file]
+            if entry is not None and entry[0] not in ("120000", "040000",
+                                                      "160000"):
+                # Regular file, the common case
+                return entry[1]
+
+            # Resolve the path one component at a time
+            parts = file.split("/")
+            resolved = []
+            n_links = 0
+            while parts:
+                part = parts.pop(0)
+                if part in ("", "."):
+                    continue
+                if part == "..":
+                    if not resolved:
+                        return None
+                    resolved.pop()
+                    continue
+
+                path = "/".join(resolved + [part])
+                self._lookup((path,))
+                entry = self._entries[path]
+                if entry is None:
+                    return None
+
+                mode, obj = entry
+                if mode == "120000":
+                    n_links += 1
+                    target = self._read_object(obj).decode("utf-8",
+                                                           "surrogateescape")
+                    if n_links > self.MAX_SYMLINKS or target.startswith("/"):
+                        return None
+                    parts = target.split("/") + parts
+                elif mode == "040000":
+                    resolved.append(part)
+                elif parts or mode == "160000":
+                    # Submodule, or file used as a directory
+                    return None
+                else:
+                    return obj
+
+            # 'file' is a directory
+            return None
+
+    def _read_object(self, obj):
+        # Returns the contents of the blob with the object ID 'obj'
+
+        if self._blobs is None:
+            self._blobs = BlobReader(GIT_TOP)
+        return self._blobs.read(obj)[1]
+
+    def isfile(self, file):
+        """
+        Returns True if 'file' (relative to GIT_TOP) is a regular file, or a
+        symbolic link to one, at 'tip'. Used to drop submodule directories
+        and deleted files from file lists.
+        """
+        with self._lock:
+            if file not in self._isfile:
+                if self.tip is None:
+                    isfile = os.path.isfile(os.path.join(GIT_TOP, file))
+                else:
+                    isfile = self._resolve(file) is not None
+                self._isfile[file] = isfile
+            return self._isfile[file]
+
+    def read(self, file):
+        """
+        Returns the contents of 'file' (relative to GIT_TOP) at 'tip', as
+        bytes. For symbolic links, this is the contents of the file they
+        point to. Raises FileNotFoundError if 'file' doesn't exist there.
+        """
+        with self._lock:
+            if ("bytes", file) in self._contents:
+                return self._contents["bytes", file]
+
+            if self.tip is None:
+                with open(os.path.join(GIT_TOP, file), "rb") as f:
+                    contents = f.read()
+            else:
+                obj = self._resolve(file)
+                if obj is None:
+                    raise FileNotFoundError(
+                        f"'{file}' not found in "
+                        f"{self.tip or 'the index'}")
+                contents = self._read_object(obj)
+
+            self._contents["bytes", file] = contents
+            return contents
+
+    def text(self, file):
+        """
+        Returns the contents of 'file' decoded as UTF-8, with newlines
+        translated as when opening the file in text mode. Raises
+        UnicodeDecodeError if 'file' isn't valid UTF-8.
+        """
+        with self._lock:
+            if ("text", file) not in self._contents:
+                self._contents["text", file] = self.read(file).decode(
+                    "utf-8").replace("\r\n", "\n").replace("\r", "\n")
+            return self._contents["text", file]
+
+    def blob_id(self, file):
+        """
+        Returns the Git blob ID (SHA-1) of the contents of 'file' at 'tip'.
+        """
+        def blob_id():
+            if self.tip is None:
+                return git_blob_id(self.read(file))
+            obj = self._resolve(file)
+            if obj is None:
+                raise FileNotFoundError(
+                    f"'{file}' not found in {self.tip or 'the index'}")
+            return obj
+
+        return self._cached(("blob_id", file), blob_id)
+
+    def mime(self, file):
+        """
+        Returns the MIME type and encoding of 'file', e.g.
+        "text/plain; charset=us-ascii". Common cases are detected by
+        sniff_mime(). libmagic is only used for the rest.
+        """
+        with self._lock:
+            if ("mime", file) not in self._contents:
+                data = self.read(file)
+                mime_type = sniff_mime(data)
+                if mime_type is None:
+                    if self._magic is None:
+                        import magic
+                        self._magic = magic.Magic(mime=True,
+                                                  mime_encoding=True)
+                    mime_type = self._magic.from_buffer(data)
+                self._contents["mime", file] = mime_type
+            return self._contents["mime", file]
+
+    def charset(self, file):
+        """
+        Returns the encoding of 'file' from mime(), e.g. "utf-8", or "binary"
+        for files that aren't text.
+        """
+        return self.mime(file).rsplit("=")[-1]
+
+    def files(self, filter=None, paths=None):
+        """
+        Returns the list of files changed in the commit range, as with
+        'git diff --name-only'. 'filter' is passed as --diff-filter, and
+        'paths' limits the list to the given paths.
+        """
+        def list_files():
+            filter_arg = (f'--diff-filter={filter}',) if filter else ()
+            paths_arg = ('--', *paths) if paths else ()
+            out = git('diff', '--name-only', *filter_arg, *self.diff_args,
+                      *paths_arg).splitlines()
+            if self.tip is not None:
+                # Look up all files with a single command
+                self._lookup(out)
+            return [file for file in out if self.isfile(file)]
+
+        return list(self._cached(("files", filter, tuple(paths or ())),
+                                 list_files))
+
+    def tree_files(self):
+        """
+        Returns the paths of all files in the tree at 'tip', or in the index
+        if 'tip' isn't a commit, as with 'git ls-files'. The list is computed
+        once.
+        """
+        def list_files():
+            if self.tip:
+                out = git('ls-tree', '-r', '-z', '--name-only', self.tip,
+                          cwd=GIT_TOP)
+            else:
+                out = git('ls-files', '-z', cwd=GIT_TOP)
+            return [file for file in out.split("\0") if file]
+
+        return list(self._cached(("tree_files",), list_files))
+
+    def paths(self):
+        """
+        Returns the paths of all files added, modified or deleted in the
+        commit range, with both the old and the new path of renamed files.
+        Unlike files(), this includes deleted files and submodules.
+        """
+        return list(self._cached(
+            ("paths",),
+            lambda: git('diff', '--name-only', '--no-renames',
+                        *self.diff_args).splitlines()))
+
+    def shas(self):
+        """
+        Returns the list of Git SHAs in the commit range.
+        """
+        return list(self._cached(("shas",),
+                                 lambda: get_shas(self.commit_range)))
+
+    def commits(self):
+        """
+        Returns the list of Commit tuples for the commit range.
+        """
+        return list(self._cached(("commits",),
+                                 lambda: list(iter_commits(self.commit_range))))
+
+    def diff(self):
+        """
+        Returns the diff for the commit range, as bytes. It is what
+        checkpatch reads, and what patchset() and changes() are parsed from.
+        """
+        def diff():
+            git_cmd = ('git', 'diff', '--no-color', '--no-ext-diff',
+                       *self.diff_args)
+            cp = run_subprocess(git_cmd, capture_output=True, cwd=GIT_TOP)
+            if cp.returncode or cp.stderr:
+                err(f"'{cmd2str(git_cmd)}' exited with status {cp.returncode} "
+                    f"and/or wrote to stderr.\n"
+                    f"==stderr==\n"
+                    f"{cp.stderr.decode('utf-8', 'replace')}\n")
+            return cp.stdout
+
+        return self._cached(("diff",), diff)
+
+    def patchset(self):
+        """
+        Returns the diff parsed into a unidiff.PatchSet. Text that isn't valid
+        UTF-8 is decoded with replacement characters.
+        """
+        return self._cached(
+            ("patchset",),
+            lambda: unidiff.PatchSet.from_string(
+                self.diff().decode("utf-8", "replace")))
+
+    def changes(self):
+        """
+        Returns a {<path>: <FileChange>} dict for the files changed in the
+        commit range, parsed from the diff.
+        """
+        def changes():
+            res = {}
+            for patch in self.patchset():
+                if patch.is_added_file:
+                    status = "A"
+                elif patch.is_removed_file:
+                    status = "D"
+                elif patch.is_rename:
+                    status = "R"
+                else:
+                    status = "M"
+
+                added_lines = [line.target_line_no for hunk in patch
+                               for line in hunk if line.is_added]
+
+                # Merge consecutive added lines into ranges
+                added_ranges = []
+                for line_no in added_lines:
+                    if added_ranges and added_ranges[-1][1] == line_no - 1:
+                        added_ranges[-1] = (added_ranges[-1][0], line_no)
+                    else:
+                        added_ranges.append((line_no, line_no))
+
+                res[patch.path] = FileChange(
+                    patch.path, status, patch.is_binary_file,
+                    frozenset(added_lines), tuple(added_ranges))
+            return res
+
+        return self._cached(("changes",), changes)
+
+    def change(self, file):
+        """
+        Returns the FileChange for 'file', or None if 'file' wasn't changed.
+        """
+        return self.changes().get(file)
+
+
+class WarmCache:
+    """
+    State that is expensive to set up, e.g. parsed configuration files, kept
+    in memory between the runs of a --serve daemon.
+
+    Each entry is validated against the modification times and sizes of the
+    files it was loaded from, so that only the entries for files that changed
+    are loaded again. Entries can be looked up from tests running in
+    parallel.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stamp(paths):
+        """
+        Returns the modification times and sizes of the files in 'paths', with
+        None for missing files.
+        """
+        stamp = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def get(self, key, paths, load):
+        """
+        Returns the value cached for 'key'. load() is called to load it if it
+        isn't cached yet, or if one of the files in 'paths' changed since.
+        """
+        # Stamp the files before loading, so that changes made while loading
+        # are picked up by the next call
+        stamp = self.stamp(paths)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[0] == stamp:
+            return entry[1]
+
+        value = load()
+        with self._lock:
+            self._entries[key] = (stamp, value)
+        return value
+
+
+# State kept between runs by a --serve daemon, or None
+WARM_CACHE = None
+
+
+def warm(key, paths, load):
+    # Returns load(), which depends on the files in 'paths'. The result is
+    # kept in WARM_CACHE when running as a --serve daemon, see WarmCache.get().
+
+    if WARM_CACHE is None:
+        return load()
+    return WARM_CACHE.get(key, paths, load)
+
+
+class VerdictCache:
+    """
+    On-disk cache for the issues that per-file tests find in a file, in the
+    'verdicts' subdirectory of the --cache-dir directory. When a test runs
+    again on a file with the same contents, e.g. when CI runs again after a
+    fixup commit, the issues are replayed instead of checking the file again.
+
+    Verdicts are keyed by the test name, the digest of this script (as the
+    version of the test), a string that identifies the configuration of the
+    test, the path of the file, and its blob ID. The path is part of the key
+    since the issues refer to it, and tests might treat some paths specially.
+
+    Each verdict is a JSON file. Using a verdict updates the modification time
+    of the file, and prune() removes the least recently used verdicts when the
+    cache grows beyond MAX_SIZE bytes.
+    """
+    MAX_SIZE = 64 << 20
+
+    def __init__(self, cache_dir):
+        self.dir = os.path.join(cache_dir, "verdicts")
+
+    @staticmethod
+    def key(*parts):
+        """
+        Returns the key for a verdict, made from the strings in 'parts'.
+        """
+        return hashlib.sha256("\0".join((file_digest(__file__), *parts))
+                              .encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """
+        Returns the verdict stored for 'key', or None if there's none.
+        """
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                verdict = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return verdict
+
+    def put(self, key, verdict):
+        """
+        Atomically stores 'verdict', which must be serializable as JSON, for
+        'key'.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(verdict, f)
+        os.replace(tmp, path)
+
+    def prune(self):
+        """
+        Removes the least recently used verdicts until the cache is no larger
+        than MAX_SIZE bytes.
+        """
+        entries = []
+        for root, _, files in os.walk(self.dir):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, file_size, path in sorted(entries):
+            if size <= self.MAX_SIZE:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            size -= file_size
+
+
+# Issues of per-file tests cached in the --cache-dir directory, or None
+VERDICTS = None
+
+
+def package_version(name):
+    # Returns the installed version of the Python package 'name', or
+    # "unknown"
+
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
 
 class FmtdFailure(Failure):
 
@@ -94,265 +1057,1221 @@ class FmtdFailure(Failure):
         msg = f'{file}' + (f':{line}' if line else '') + f' {msg_body}'
         typ = severity.lower()
 
-        super().__init__(msg, typ)
+        super().__init__(msg, typ)
+
+        self.text = txt
+
+
+class ComplianceTest:
+    """
+    Base class for tests. Inheriting classes should have a run() method and set
+    these class variables:
+
+    name:
+      Test name
+
+    doc:
+      Link to documentation related to what's being tested
+
+    path_hint:
+      The path the test runs itself in. This is just informative and used in
+      the message that gets printed when running the test.
+
+      There are three magic strings that can be used instead of a path:
+      - The magic string "<bridle-base>" can be used to refer to the
+      environment variable BRIDLE_BASE or, when missing, the calculated base of
+      the bridle tree
+      - The magic string "<zephyr-base>" can be used to refer to the
+      environment variable ZEPHYR_BASE or, when missing, the calculated base of
+      the zephyr tree
+      - The magic string "<git-top>" refers to the top-level repository
+      directory. This avoids running 'git' to find the top-level directory
+      before main() runs (class variable assignments run when the 'class ...'
+      statement runs). That avoids swallowing errors, because main() reports
+      them to GitHub
+
+    isolated:
+      Set to True for tests that modify process-global state (os.environ,
+      module globals, ...) while running. When tests are run in parallel
+      (--jobs), isolated tests are run one after another in a separate
+      worker process instead of in a thread of the main process. Any test
+      can add directories to sys.path with add_sys_path(). Defaults to False
+
+    high_signal:
+      Set to True for cheap tests that often find problems. With --budget,
+      these tests run first. Defaults to False
+
+    per_file:
+      Set to True for tests that only look at the changed files (and their
+      diffs), and not at commits or at the rest of the tree. Only these tests
+      run with --staged and --worktree. Defaults to False
+
+    inputs:
+      Tuple with fnmatch patterns for the files the test checks, relative to
+      the top-level repository directory. The test is skipped if none of the
+      files changed in the commit range match, see inputs_changed(). Defaults
+      to ()
+
+    always_run:
+      Set to True for tests that run regardless of the changed files (and
+      'inputs'), e.g. because they check commits rather than files. Defaults
+      to False
+    """
+    isolated = False
+    high_signal = False
+    per_file = False
+    inputs = ()
+    always_run = False
+
+    @classmethod
+    def inputs_changed(cls, files):
+        """
+        Returns True if the test needs to run for the files changed in the
+        commit range, 'files' (see RepoSnapshot.paths()).
+        """
+        return cls.always_run or \
+            any(fnmatch.fnmatchcase(file, pattern)
+                for file in files for pattern in cls.inputs)
+
+    def __init__(self):
+        self.case = TestCase(type(self).name, "Guidelines")
+        # This is necessary because Failure can be subclassed, but since it is
+        # always restored form the element tree, the subclass is lost upon
+        # restoring
+        self.fmtd_failures = []
+        # Issues recorded by cached_check(), or None
+        self._verdict = None
+
+    def _result(self, res, text):
+        res.text = text.rstrip()
+        # Appended directly, since assigning to TestCase.result removes and
+        # adds back all earlier results, which is slow for many failures
+        self.case.append(res)
+
+    def get_verdict(self, file, config, blob=None):
+        """
+        Returns the issues cached for 'file' (see VerdictCache), as a list
+        that can be passed to replay(), or None if there are none. 'config' is
+        a string that identifies everything else the issues depend on, e.g.
+        digests of the configuration files and the version of the tool, or
+        the added lines for tests that only report issues on those. 'blob' is
+        the blob ID (see git_blob_id()) of the contents that are checked, if
+        the test doesn't check the contents of 'file' in REPO.
+        """
+        if VERDICTS is None:
+            return None
+        return VERDICTS.get(VERDICTS.key(self.name, config, file,
+                                         blob or REPO.blob_id(file)))
+
+    def put_verdict(self, file, config, verdict, blob=None):
+        """
+        Stores the issues for 'file', 'verdict', in the verdict cache. See
+        get_verdict().
+        """
+        if VERDICTS is not None:
+            VERDICTS.put(VERDICTS.key(self.name, config, file,
+                                      blob or REPO.blob_id(file)),
+                         verdict)
+
+    def replay(self, verdict):
+        """
+        Reports the issues in 'verdict', a list of (<method name>,
+        <arguments>) pairs for failure() and fmtd_failure().
+        """
+        for method, args in verdict:
+            getattr(self, method)(*args)
+
+    def cached_check(self, file, config, check):
+        """
+        Calls check(), which checks 'file' and reports the issues it finds
+        with failure() and fmtd_failure(). With --cache-dir, the issues are
+        cached, and replayed instead of calling check() again as long as
+        neither the contents of 'file' nor 'config' changed (see
+        get_verdict()). check() can return False to keep the issues from being
+        cached, e.g. if a tool couldn't be run.
+        """
+        verdict = self.get_verdict(file, config)
+        if verdict is not None:
+            self.replay(verdict)
+            return
+
+        self._verdict = []
+        try:
+            cache = check() is not False
+            verdict = self._verdict
+        finally:
+            self._verdict = None
+
+        if cache:
+            self.put_verdict(file, config, verdict)
+
+    def error(self, text, msg=None, type_="error"):
+        """
+        Signals a problem with running the test, with message 'msg'.
+
+        Raises an exception internally, so you do not need to put a 'return'
+        after error().
+        """
+        err = Error(msg or f'{type(self).name} error', type_)
+        self._result(err, text)
+
+        raise EndTest
+
+    def skip(self, text, msg=None, type_="skip"):
+        """
+        Signals that the test should be skipped, with message 'msg'.
+
+        Raises an exception internally, so you do not need to put a 'return'
+        after skip().
+        """
+        skpd = Skipped(msg or f'{type(self).name} skipped', type_)
+        self._result(skpd, text)
+
+        raise EndTest
+
+    def failure(self, text, msg=None, type_="failure"):
+        """
+        Signals that the test failed, with message 'msg'. Can be called many
+        times within the same test to report multiple failures.
+        """
+        if self._verdict is not None:
+            self._verdict.append(("failure", (text, msg, type_)))
+
+        fail = Failure(msg or f'{type(self).name} issues', type_)
+        self._result(fail, text)
+
+    def fmtd_failure(self, severity, title, file, line=None, col=None, desc=""):
+        """
+        Signals that the test failed, and store the information in a formatted
+        standardized manner. Can be called many times within the same test to
+        report multiple failures.
+        """
+        if self._verdict is not None:
+            self._verdict.append(("fmtd_failure",
+                                  (severity, title, file, line, col, desc)))
+
+        fail = FmtdFailure(severity, title, file, line, col, desc)
+        self._result(fail, fail.text)
+        self.fmtd_failures.append(fail)
+
+class EndTest(Exception):
+    """
+    Raised by ComplianceTest.error()/skip() to end the test.
+
+    Tests can raise EndTest themselves to immediately end the test, e.g. from
+    within a nested function call.
+    """
+
+
+class CheckPatch(ComplianceTest):
+    """
+    Runs checkpatch and reports found issues
+
+    """
+    name = "Checkpatch"
+    doc = "See https://docs.zephyrproject.org/latest/contribute/guidelines.html#coding-style for more details."
+    path_hint = "<git-top>"
+    per_file = True
+    inputs = ("*",)
+
+    # An issue, e.g. "-:12: WARNING:LONG_LINE: line length of 104 exceeds 100
+    # columns" (with --emacs and --show-types from .checkpatch.conf)
+    ISSUE_RE = re.compile(r"^\s*\S+:(\d+):\s*(ERROR|WARNING|CHECK):(.+?):(.+)$")
+    # The location of the preceding issue, e.g. "#12: FILE: foo.c:3:", or
+    # "#5: FILE: foo.c" for issues that don't apply to a particular line
+    FILE_RE = re.compile(r"^\s*#(\d+):\s*FILE:\s*(.+?)(?::(\d+):)?$")
+
+    def run(self):
+        checkpatch = os.path.join(BRIDLE_BASE, 'scripts', 'checkpatch.pl')
+        if not os.path.exists(checkpatch):
+            self.skip(f'{checkpatch} not found')
+
+        # The diff of each file, split at the "diff --git" lines
+        chunks = [chunk for chunk in
+                  re.split(rb"^(?=diff --git )", REPO.diff(), flags=re.M)
+                  if chunk]
+        if not chunks:
+            return
+
+        cmd = (checkpatch, *self.config_args(), '--mailback', '--no-tree', '-')
+
+        profile = CheckProfile.current()
+        with JOB_SLOTS.workers(len(chunks)) as n_batches, \
+             ThreadPoolExecutor(max_workers=n_batches) as executor:
+            # A single checkpatch run checks the whole diff unless there are
+            # idle --jobs slots. Otherwise, the diff is split into one batch
+            # of files per slot, of about the same size, and checkpatch runs
+            # on the batches in parallel.
+            for issues, output, duration in executor.map(
+                    lambda batch: self.check_batch(cmd, batch),
+                    self.split_batches(chunks, n_batches)):
+                if profile:
+                    profile.add_subprocess(duration)
+
+                for severity, title, file, line, desc in issues:
+                    self.fmtd_failure(severity, title, file, line, desc=desc)
+
+                # If checkpatch failed without reporting issues, add its whole
+                # output as a failure
+                if output is not None:
+                    self.failure(output)
+
+    @staticmethod
+    def config_args():
+        # Returns the options in the .checkpatch.conf file of the repository,
+        # split into words as checkpatch does, if checkpatch can't read the
+        # file itself. checkpatch looks for it in the working directory,
+        # which a bare repository doesn't have. The output can only be parsed
+        # with the --emacs and --show-types options from the file.
+
+        if os.path.exists(os.path.join(GIT_TOP, ".checkpatch.conf")) or \
+           not REPO.isfile(".checkpatch.conf"):
+            return []
+
+        args = []
+        for line in REPO.text(".checkpatch.conf").splitlines():
+            for word in line.split():
+                if word.startswith("#"):
+                    break
+                args.append(word)
+        return args
+
+    @staticmethod
+    def split_batches(chunks, n_batches):
+        # Splits the list of per-file diffs 'chunks' into 'n_batches' lists of
+        # consecutive diffs with about the same total size. The diff order is
+        # kept, so that the issues are reported in the same order as with a
+        # single batch.
+
+        # Each diff goes to the batch its middle falls into
+        total = sum(map(len, chunks))
+        batches = [[] for _ in range(n_batches)]
+        size = 0
+        for chunk in chunks:
+            middle = size + len(chunk) // 2
+            batches[min(n_batches - 1, middle * n_batches // total)].append(
+                chunk)
+            size += len(chunk)
+        return [batch for batch in batches if batch]
+
+    def check_batch(self, cmd, batch):
+        # Runs the checkpatch command 'cmd' on 'batch', a list with the diffs
+        # of one or more files. Returns a (<issues>, <output>, <duration>)
+        # tuple, with a (<severity>, <type>, <file>, <line>, <description>)
+        # tuple per issue, parsed while checkpatch runs. <output> is the output
+        # of checkpatch if it failed without reporting any issues, and None
+        # otherwise.
+
+        # Issues without a FILE: line are reported for the file whose diff
+        # contains the line of the input the issue is for. 'starts' has the
+        # number of the first line of each diff in the input.
+        starts = []
+        chunk_files = []
+        n_lines = 0
+        for chunk in batch:
+            m = re.match(rb"diff --git a/.* b/(.*)", chunk)
+            starts.append(n_lines + 1)
+            chunk_files.append(m.group(1).decode("utf-8", "replace")
+                               if m else None)
+            n_lines += chunk.count(b"\n")
+
+        issues = []
+        lines = []
+        issue = None
+
+        def add_issue(file, line):
+            input_line, severity, title, desc = issue
+            if file is None:
+                file = chunk_files[max(0, bisect.bisect_right(starts,
+                                                              input_line) - 1)]
+            issues.append((severity, title, file, line, desc))
+
+        start = time.perf_counter()
+        # checkpatch reads all of its input before it prints anything, so
+        # writing the input before reading the output can't deadlock
+        with subprocess.Popen(cmd,
+                              stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT,
+                              cwd=GIT_TOP) as proc:
+            proc.stdin.write(b"".join(batch))
+            proc.stdin.close()
+
+            for line in io.TextIOWrapper(proc.stdout, encoding="utf-8",
+                                         errors="replace"):
+                line = line.rstrip("\r\n")
+                if not issues and issue is None:
+                    lines.append(line)
+
+                m = self.ISSUE_RE.match(line)
+                if m:
+                    if issue:
+                        add_issue(None, None)
+                    severity = "notice" if m.group(2) == "CHECK" \
+                        else m.group(2).lower()
+                    issue = (int(m.group(1)), severity, m.group(3),
+                             m.group(4).strip())
+                    continue
+
+                m = self.FILE_RE.match(line)
+                if m and issue:
+                    add_issue(m.group(2),
+                              m.group(3) and int(m.group(3)))
+                    issue = None
+
+        if issue:
+            add_issue(None, None)
+
+        output = None
+        if proc.returncode and not issues:
+            output = "\n".join(lines)
+
+        return issues, output, time.perf_counter() - start
+
+
+class BoardYmlCheck(ComplianceTest):
+    """
+    Check the board.yml files in the board root of the module (see
+    board_dirs()). Only the changed board.yml files are checked, unless a
+    vendor-prefixes.txt file or the module.yml file changed, or --all-checks
+    is given.
+    """
+    name = "BoardYml"
+    doc = "Check the board.yml file format"
+    path_hint = "<git-top>"
+    inputs = ("*board.yml", "*vendor-prefixes.txt", "*zephyr/module.yml",
+              "*zephyr/module.yaml")
+
+    def check_board_file(self, file, vendor_prefixes):
+        """Validate a single board file."""
+        for line_num, line in enumerate(REPO.text(file).splitlines(),
+                                        start=1):
+            if "vendor:" in line:
+                _, vnd = line.strip().split(":", 2)
+                vnd = vnd.strip()
+                if vnd not in vendor_prefixes:
+                    desc = f"invalid vendor: {vnd}"
+                    self.fmtd_failure("error", "BoardYml", file, line_num,
+                                      desc=desc)
+
+    @staticmethod
+    def parse_vendor_prefixes(path, text):
+        # Returns a (<vendor prefixes>, <invalid lines>) tuple for 'text', the
+        # contents of the vendor-prefixes.txt file 'path'. <vendor prefixes>
+        # is a frozenset, and <invalid lines> a list of (<path>, <line>)
+        # tuples.
+
+        vendor_prefixes = set()
+        invalid = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                vendor, _ = line.split("\t", 2)
+                vendor_prefixes.add(vendor)
+            except ValueError:
+                invalid.append((path, line))
+        return frozenset(vendor_prefixes), invalid
+
+    @classmethod
+    def load_vendor_prefixes(cls, path):
+        # parse_vendor_prefixes() for the file 'path' on disk
+
+        with open(path) as fp:
+            return cls.parse_vendor_prefixes(path, fp.read())
+
+    @staticmethod
+    def board_dirs():
+        # Returns the 'boards' directories in the board root set in the
+        # zephyr/module.yml file of the repository, relative to GIT_TOP
+
+        for module_file in ("zephyr/module.yml", "zephyr/module.yaml"):
+            if REPO.isfile(module_file):
+                module = yaml.safe_load(REPO.text(module_file))
+                break
+        else:
+            return []
+
+        try:
+            board_root = module["build"]["settings"]["board_root"]
+        except (KeyError, TypeError):
+            return []
+        return [os.path.normpath(os.path.join(board_root, "boards"))]
+
+    def run(self):
+        zephyr_path = os.path.join(ZEPHYR_BASE, "dts", "bindings",
+                                   "vendor-prefixes.txt")
+        vendor_prefixes, invalid = warm(
+            ("vendor-prefixes", zephyr_path), [zephyr_path],
+            lambda: self.load_vendor_prefixes(zephyr_path))
+        vendor_prefixes |= {"others"}
+
+        # Bridle's own vendor prefixes extend Zephyr's. They are read from
+        # the snapshot, like the board files.
+        path = "dts/bindings/vendor-prefixes.txt"
+        if REPO.isfile(path) and \
+           os.path.join(GIT_TOP, path) != zephyr_path:
+            bridle_prefixes, bridle_invalid = self.parse_vendor_prefixes(
+                path, REPO.text(path))
+            vendor_prefixes |= bridle_prefixes
+            invalid = invalid + bridle_invalid
+
+        for path, line in invalid:
+            self.error(f"Invalid line in {path}:\"{line}\".")
+            self.error("Did you forget the tab character?")
+
+        if RUN_ALL or any(os.path.basename(file) in
+                          ("vendor-prefixes.txt", "module.yml", "module.yaml")
+                          for file in get_files()):
+            # A changed vendor list or board root affects unchanged board
+            # files too
+            files = REPO.tree_files()
+        else:
+            files = get_files(filter="d")
+
+        board_dirs = self.board_dirs()
+        for file in files:
+            if os.path.basename(file) == "board.yml" and \
+               any(file.startswith(board_dir + "/")
+                   for board_dir in board_dirs):
+                self.check_board_file(file, vendor_prefixes)
+
+
+class ClangFormatCheck(ComplianceTest):
+    """
+    Check if clang-format reports any issues
+    """
+    name = "ClangFormat"
+    doc = "See https://docs.zephyrproject.org/latest/contribute/guidelines.html#clang-format for more details."
+    path_hint = "<git-top>"
+    per_file = True
+    inputs = ("*.c", "*.h", ".clang-format")
+
+    # Number of added lines above which the files are spread over several
+    # clang-format-diff processes
+    MAX_BATCH_LINES = 5000
+
+    def run(self):
+        exe = f"clang-format-diff.{'exe' if platform.system() == 'Windows' else 'py'}"
+
+        # (<file>, <added line ranges>, <number of added lines>) tuples
+        files = []
+        for file in get_files():
+            if Path(file).suffix not in ['.c', '.h']:
+                continue
+
+            change = REPO.change(file)
+            if not change or not change.added_ranges:
+                continue
+
+            files.append((file, change.added_ranges,
+                          sum(last - first + 1
+                              for first, last in change.added_ranges)))
+
+        if not files:
+            return
+
+        # Format all files with a single clang-format-diff, unless the change
+        # is large and there are idle --jobs slots (see JobSlots)
+        n_batches = 1
+        if sum(n_lines for _, _, n_lines in files) > self.MAX_BATCH_LINES:
+            n_batches = len(files)
+
+        with JOB_SLOTS.workers(n_batches) as n_batches:
+            if n_batches == 1:
+                patchsets = [self.format_batch(exe, files)]
+            else:
+                batches = [files[i::n_batches] for i in range(n_batches)]
+                with ThreadPoolExecutor(max_workers=n_batches) as executor:
+                    patchsets = list(executor.map(
+                        lambda batch: self.format_batch(exe, batch), batches))
+
+        patches = {patch.path: patch
+                   for patchset in patchsets for patch in patchset}
+
+        for file, _, _ in files:
+            if file not in patches:
+                continue
+
+            for hunk in patches[file]:
+                # Strip the before and after context
+                before = next(i for i,v in enumerate(hunk) if str(v).startswith(('-', '+')))
+                after = next(i for i,v in enumerate(reversed(hunk)) if str(v).startswith(('-', '+')))
+                msg = "".join([str(l) for l in hunk[before:-after or None]])
+
+                # show the hunk at the last line
+                self.fmtd_failure("notice",
+                                  "You may want to run clang-format on this change",
+                                  file, line=hunk.source_start + hunk.source_length - after,
+                                  desc=f'\r\n{msg}')
+
+    @staticmethod
+    def format_batch(exe, batch):
+        # Runs clang-format-diff on the files in 'batch', a list of (<file>,
+        # <added line ranges>, <number of added lines>) tuples. Returns the
+        # changes it suggests, as a unidiff.PatchSet.
+
+        # clang-format-diff only looks at the file names and at the added line
+        # ranges in the hunk headers, and formats the added lines
+        diff = "".join(
+            f"--- a/{file}\n+++ b/{file}\n" +
+            "".join(f"@@ -0,0 +{first},{last - first + 1} @@\n"
+                    for first, last in added_ranges)
+            for file, added_ranges, _ in batch)
+
+        try:
+            run_subprocess((exe, '-p1'),
+                           check=True,
+                           input=diff.encode("utf-8"),
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT,
+                           cwd=GIT_TOP)
+        except subprocess.CalledProcessError as ex:
+            return unidiff.PatchSet.from_string(ex.output, encoding="utf-8")
+
+        return []
+
+
+class DevicetreeBindingsCheck(ComplianceTest):
+    """
+    Checks if we are introducing any unwanted properties in Devicetree Bindings.
+    """
+    name = "DevicetreeBindings"
+    doc = "See https://docs.zephyrproject.org/latest/build/dts/bindings.html for more details."
+    path_hint = "<zephyr-base>"
+    inputs = ("*dts/bindings/*.yaml",)
+
+    def run(self, full=True):
+        dts_bindings = self.parse_dt_bindings()
+
+        for dts_binding in dts_bindings:
+            self.required_false_check(dts_binding)
+
+    def parse_dt_bindings(self):
+        """
+        Returns a list of dts/bindings/**/*.yaml files
+        """
+
+        dt_bindings = []
+        for file_name in get_files(filter="d"):
+            if 'dts/bindings/' in file_name and file_name.endswith('.yaml'):
+                dt_bindings.append(file_name)
+
+        return dt_bindings
+
+    def required_false_check(self, dts_binding):
+        with open(dts_binding) as file:
+            line_number = 0
+            for line in file:
+                line_number += 1
+                if 'required: false' in line:
+                    self.fmtd_failure(
+                        'warning', 'Devicetree Bindings', dts_binding,
+                        line_number, col=None,
+                        desc="'required: false' is redundant, please remove")
+
+
+# A menu node of a parsed Kconfig tree, as stored in a KconfigTree.
+#
+# 'kind' is one of "symbol", "choice", "menu" and "comment". 'name' is the name
+# of the symbol or choice (None for unnamed choices), or the Kconfig
+# representation of the menu or comment. 'type' is the type of the symbol or
+# choice as a string ("bool", "int", ...), 'prompt' the prompt text or None,
+# and 'defaults' holds the names of the symbols used as 'default' values on
+# the node.
+KconfigNode = collections.namedtuple(
+    "KconfigNode",
+    "filename linenr kind name type prompt has_help is_menuconfig has_children "
+    "defaults")
+
+
+class KconfigTree:
+    """
+    The parts of a parsed Kconfig tree (a kconfiglib.Kconfig instance) the
+    Kconfig tests look at.
+
+    Unlike a kconfiglib.Kconfig instance, a KconfigTree is made of plain
+    Python objects only and can be pickled, which is what the on-disk Kconfig
+    cache stores.
+
+    nodes:
+      List of KconfigNode tuples, for all menu nodes in kconf.node_iter()
+      order
+
+    warnings:
+      List of the warnings generated while parsing
+
+    n_top_prompts:
+      Number of items with prompts in the top-level menu
+
+    defined_syms:
+      Set with the names of all defined symbols and choices
+
+    filenames:
+      List of the Kconfig files parsed, relative to $srctree when possible
+    """
+    def __init__(self, nodes, warnings, n_top_prompts, defined_syms,
+                 filenames):
+        self.nodes = nodes
+        self.warnings = warnings
+        self.n_top_prompts = n_top_prompts
+        self.defined_syms = defined_syms
+        self.filenames = filenames
+
+    @classmethod
+    def from_kconfig(cls, kconf):
+        """
+        Creates a KconfigTree from the kconfiglib.Kconfig instance 'kconf'.
+        """
+        # 'kconfiglib' is global
+        # pylint: disable=undefined-variable
+
+        kinds = {kconfiglib.MENU: "menu", kconfiglib.COMMENT: "comment"}
+
+        nodes = []
+        for node in kconf.node_iter():
+            item = node.item
+            if isinstance(item, kconfiglib.Symbol):
+                kind, name = "symbol", item.name
+            elif isinstance(item, kconfiglib.Choice):
+                kind, name = "choice", item.name
+            else:
+                kind, name = kinds[item], str(node)
+
+            nodes.append(KconfigNode(
+                node.filename, node.linenr, kind, name,
+                kconfiglib.TYPE_TO_STR[item.type] if kind in ("symbol", "choice")
+                else None,
+                node.prompt[0] if node.prompt else None,
+                bool(node.help), node.is_menuconfig, node.list is not None,
+                tuple(default.name for default, _ in node.defaults
+                      if isinstance(default, kconfiglib.Symbol))))
+
+        n_top_prompts = 0
+        node = kconf.top_node.list
+        while node:
+            # Only count items with prompts. Other items will never be
+            # shown in the menuconfig (outside show-all mode).
+            if node.prompt:
+                n_top_prompts += 1
+            node = node.next
+
+        defined_syms = {sym.name for sym in
+                        kconf.unique_defined_syms + kconf.unique_choices}
+
+        return cls(nodes, list(kconf.warnings), n_top_prompts, defined_syms,
+                   list(kconf.kconfig_filenames))
+
+    def to_state(self):
+        """
+        Returns the tree as a tuple of built-in types, for pickling. This keeps
+        the pickled data independent of the module the classes live in (the
+        script can be run as __main__ or imported). See from_state().
+        """
+        return ([tuple(node) for node in self.nodes], self.warnings,
+                self.n_top_prompts, self.defined_syms, self.filenames)
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Creates a KconfigTree from a to_state() tuple.
+        """
+        nodes, *rest = state
+        return cls([KconfigNode._make(node) for node in nodes], *rest)
+
+
+def dir_digest(path):
+    # Returns a digest of the names and contents of the files below the
+    # directory 'path'
+
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            digest.update(f"{os.path.relpath(file_path, path)}\0"
+                          f"{file_digest(file_path)}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    # Returns the SHA-256 hex digest of the contents of the file 'path'. A
+    # --serve daemon only hashes the file again if its modification time
+    # changed.
+
+    def digest():
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    return warm(("digest", path), [path], digest)
+
+
+def git_files_digest(root, pathspecs):
+    """
+    Returns a digest of the contents of all files below the Git repository
+    'root' that match 'pathspecs', or None if 'root' is not a Git repository.
+
+    Tracked files are hashed via the blob IDs in the Git index, so this stays
+    cheap for large trees. Files that are modified in the working tree or
+    untracked (but not ignored) are hashed from disk.
+    """
+    if not os.path.exists(os.path.join(root, ".git")):
+        return None
+
+    digest = hashlib.sha256()
+    digest.update(git("ls-files", "--stage", "--", *pathspecs,
+                      cwd=root).encode("utf-8"))
+
+    changed = git("ls-files", "--modified", "--others", "--exclude-standard",
+                  "--", *pathspecs, cwd=root)
+    for file in sorted(set(changed.splitlines())):
+        path = os.path.join(root, file)
+        digest.update(f"\0{file}\0".encode("utf-8"))
+        digest.update((file_digest(path) if os.path.isfile(path)
+                       else "deleted").encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def west_modules_digest():
+    """
+    Returns a digest of the Zephyr modules in the west workspace, i.e. of the
+    input that zephyr_module.py generates the module settings from. Returns
+    None if there is no usable west workspace.
+    """
+    try:
+        manifest = Manifest.from_file()
+    # west raises a variety of exceptions for missing or broken workspaces
+    except Exception as e:
+        logger.info(f"Can't load west manifest: {e}")
+        return None
+
+    digest = hashlib.sha256()
+    for var in ("ZEPHYR_MODULES", "EXTRA_ZEPHYR_MODULES"):
+        digest.update(f"{var}={os.environ.get(var)}\0".encode("utf-8"))
+
+    for project in manifest.get_projects([]):
+        if not manifest.is_active(project):
+            continue
+
+        digest.update(f"{project.name}\0{project.abspath}\0".encode("utf-8"))
+        for file in ("module.yml", "module.yaml", "CMakeLists.txt", "Kconfig"):
+            path = os.path.join(project.abspath, "zephyr", file)
+            if os.path.isfile(path):
+                digest.update(f"{file}\0{file_digest(path)}\0".encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+class KconfigCache:
+    """
+    On-disk cache for KconfigCheck.parse_kconfig(), in the 'kconfig'
+    subdirectory of the --cache-dir directory.
+
+    For each Kconfig variant (module setup and top-level Kconfig file), the
+    cache holds:
+
+    - A directory with the generated Kconfig files (Kconfig.modules,
+      Kconfig.dts and the HWMv2 board, SoC and architecture files), which is
+      used as KCONFIG_BINARY_DIR when parsing. It is keyed by a digest of the
+      module settings, and validated against the contents of the board, SoC,
+      architecture and binding files the generators read.
+
+    - The parsed tree, as a pickled KconfigTree. It is only used if the
+      generated files are valid and no Kconfig file changed: every parsed
+      Kconfig file must have the same content hash as when the tree was
+      stored, and no Kconfig file can have been added to the Zephyr tree or to
+      the module roots the generated files refer to.
+
+    The digest of this script is part of the key, so that changes to the
+    generators or to KconfigTree invalidate the cache.
+    """
+    # Files below Zephyr and the board/SoC/DTS/module roots that the generated
+    # Kconfig files depend on
+    GENERATED_PATHSPECS = (
+        ":(glob)**/board.yml",
+        ":(glob)**/soc.yml",
+        ":(glob)**/archs.yml",
+        ":(glob)**/dts/bindings/**",
+        ":(glob)modules/*/Kconfig",
+        ":(glob)scripts/**/*.py",
+    )
+
+    # Files below Zephyr and the module roots that can be sourced when parsing
+    KCONFIG_PATHSPECS = (
+        ":(glob)**/Kconfig*",
+    )
+
+    def __init__(self, cache_dir, filename, no_modules):
+        """
+        Sets up the cache for the Kconfig variant given by 'filename' and
+        'no_modules' (see KconfigCheck.run()). 'enabled' is set to False if
+        the variant can't be cached, e.g. because the module settings can't be
+        determined without a west workspace.
+        """
+        self.dir = os.path.join(cache_dir, "kconfig")
+
+        modules_digest = "" if no_modules else west_modules_digest()
+        self.enabled = modules_digest is not None
+
+        key = hashlib.sha256(f"{file_digest(__file__)}\0{ZEPHYR_BASE}\0"
+                             f"{no_modules}\0{modules_digest}".encode("utf-8"))
+        self.generated_dir = os.path.join(self.dir,
+                                          f"gen-{key.hexdigest()[:16]}")
+
+        key.update(f"\0{filename}".encode("utf-8"))
+        self.tree_file = os.path.join(self.dir,
+                                      f"tree-{key.hexdigest()[:16]}.pickle")
+
+    @staticmethod
+    def _roots_digests(roots, pathspecs):
+        # Returns a {<root>: <digest>} dict for the repositories in 'roots'
+
+        return {root: git_files_digest(root, pathspecs) for root in roots}
+
+    def _load(self, path):
+        # Returns the unpickled contents of 'path', or None if it's missing or
+        # unreadable
+
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.info(f"Kconfig cache: can't load {path}: {e}")
+            return None
+
+    def _store(self, path, data):
+        # Atomically pickles 'data' to 'path'
+
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def generated_valid(self):
+        """
+        Returns True if the generated Kconfig files in 'generated_dir' can be
+        used.
+        """
+        stamp = self._load(os.path.join(self.generated_dir, "stamp.pickle"))
+        return stamp is not None and None not in stamp.values() and \
+            stamp == self._roots_digests(stamp, self.GENERATED_PATHSPECS)
 
-        self.text = txt
+    def prepare_generated(self):
+        """
+        Empties 'generated_dir', for the Kconfig files to be generated in it.
+        """
+        shutil.rmtree(self.generated_dir, ignore_errors=True)
+        os.makedirs(self.generated_dir)
 
+    def store_generated(self, roots):
+        """
+        Marks the files generated in 'generated_dir' as valid. 'roots' are the
+        Zephyr and module directories the generators read from.
+        """
+        self._store(os.path.join(self.generated_dir, "stamp.pickle"),
+                    self._roots_digests(roots, self.GENERATED_PATHSPECS))
 
-class ComplianceTest:
-    """
-    Base class for tests. Inheriting classes should have a run() method and set
-    these class variables:
+    def load_tree(self):
+        """
+        Returns the cached KconfigTree, or None if there's no valid one.
+        """
+        if not self.generated_valid():
+            return None
 
-    name:
-      Test name
+        def load():
+            entry = self._load(self.tree_file)
+            if entry is None:
+                return None
+            roots, file_digests, state = entry
+            return roots, file_digests, KconfigTree.from_state(state)
 
-    doc:
-      Link to documentation related to what's being tested
+        # A --serve daemon keeps the unpickled tree in memory
+        entry = warm(("kconfig-tree", self.tree_file), [self.tree_file], load)
+        if entry is None:
+            return None
 
-    path_hint:
-      The path the test runs itself in. This is just informative and used in
-      the message that gets printed when running the test.
+        roots, file_digests, tree = entry
+        for path, digest in file_digests.items():
+            if not os.path.isfile(path) or file_digest(path) != digest:
+                return None
 
-      There are three magic strings that can be used instead of a path:
-      - The magic string "<bridle-base>" can be used to refer to the
-      environment variable BRIDLE_BASE or, when missing, the calculated base of
-      the bridle tree
-      - The magic string "<zephyr-base>" can be used to refer to the
-      environment variable ZEPHYR_BASE or, when missing, the calculated base of
-      the zephyr tree
-      - The magic string "<git-top>" refers to the top-level repository
-      directory. This avoids running 'git' to find the top-level directory
-      before main() runs (class variable assignments run when the 'class ...'
-      statement runs). That avoids swallowing errors, because main() reports
-      them to GitHub
-    """
-    def __init__(self):
-        self.case = TestCase(type(self).name, "Guidelines")
-        # This is necessary because Failure can be subclassed, but since it is
-        # always restored form the element tree, the subclass is lost upon
-        # restoring
-        self.fmtd_failures = []
+        if None in roots.values() or \
+           roots != self._roots_digests(roots, self.KCONFIG_PATHSPECS):
+            return None
 
-    def _result(self, res, text):
-        res.text = text.rstrip()
-        self.case.result += [res]
+        return tree
 
-    def error(self, text, msg=None, type_="error"):
+    def store_tree(self, tree, roots):
         """
-        Signals a problem with running the test, with message 'msg'.
-
-        Raises an exception internally, so you do not need to put a 'return'
-        after error().
+        Stores 'tree', which must have been parsed with the generated files in
+        'generated_dir'. 'roots' are the directories to check for added
+        Kconfig files when loading the tree.
         """
-        err = Error(msg or f'{type(self).name} error', type_)
-        self._result(err, text)
+        file_digests = {}
+        for filename in tree.filenames:
+            path = os.path.join(ZEPHYR_BASE, filename)
+            if not path.startswith(self.generated_dir + os.sep):
+                file_digests[path] = file_digest(path)
 
-        raise EndTest
+        self._store(self.tree_file,
+                    (self._roots_digests(roots, self.KCONFIG_PATHSPECS),
+                     file_digests, tree.to_state()))
 
-    def skip(self, text, msg=None, type_="skip"):
-        """
-        Signals that the test should be skipped, with message 'msg'.
 
-        Raises an exception internally, so you do not need to put a 'return'
-        after skip().
-        """
-        skpd = Skipped(msg or f'{type(self).name} skipped', type_)
-        self._result(skpd, text)
+class KconfigSession:
+    """
+    Kconfig files generated and trees parsed by the Kconfig tests during a
+    run. The Kconfig* tests only differ in the module setup and in the
+    top-level Kconfig file, so the generated files are shared by all tests
+    with the same module setup, and each tree is only parsed once.
 
-        raise EndTest
+    The Kconfig tests are 'isolated' and run one after another in the same
+    process, so no locking is needed.
 
-    def failure(self, text, msg=None, type_="failure"):
+    generated:
+      Maps the 'no_modules' flag to a (<KCONFIG_BINARY_DIR>, <roots>) tuple,
+      where <roots> are the Zephyr and module directories the generated files
+      were made from (see KconfigCheck.get_module_roots())
+
+    trees:
+      Maps (<no_modules>, <Kconfig filename>) tuples to KconfigTree instances
+
+    sample_syms:
+      The KconfigCheck.get_sample_syms() result, or None before it's needed
+    """
+    def __init__(self):
+        self.generated = {}
+        self.trees = {}
+        self.sample_syms = None
+        self._tmpdir = None
+
+    def mkdtemp(self):
         """
-        Signals that the test failed, with message 'msg'. Can be called many
-        times within the same test to report multiple failures.
+        Returns a new temporary directory, which is removed by close().
         """
-        fail = Failure(msg or f'{type(self).name} issues', type_)
-        self._result(fail, text)
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix="kconfiglib_")
+        return tempfile.mkdtemp(dir=self._tmpdir)
 
-    def fmtd_failure(self, severity, title, file, line=None, col=None, desc=""):
+    def close(self):
         """
-        Signals that the test failed, and store the information in a formatted
-        standardized manner. Can be called many times within the same test to
-        report multiple failures.
+        Removes the temporary directories and forgets the generated files in
+        them, and the trees and symbols of the run.
         """
-        fail = FmtdFailure(severity, title, file, line, col, desc)
-        self._result(fail, fail.text)
-        self.fmtd_failures.append(fail)
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+        self.generated.clear()
+        self.trees.clear()
+        self.sample_syms = None
 
-class EndTest(Exception):
-    """
-    Raised by ComplianceTest.error()/skip() to end the test.
 
-    Tests can raise EndTest themselves to immediately end the test, e.g. from
-    within a nested function call.
-    """
+# Kconfig files and trees shared by the Kconfig tests of this run
+KCONFIG_SESSION = KconfigSession()
 
 
-class CheckPatch(ComplianceTest):
+class ConfigRefIndex:
     """
-    Runs checkpatch and reports found issues
-
+    Index of the references to Kconfig symbols (CONFIG_FOO) in the files of
+    the Git repository 'root', for
+    KconfigCheck.check_no_undef_outside_kconfig().
+
+    The index maps Git blob IDs to the references in the blob, so only files
+    with contents that weren't indexed before need to be searched. With a
+    'cache_dir' (--cache-dir), the index is kept on disk between runs, in its
+    'config-refs' subdirectory. Files modified in the working tree are
+    indexed by the blob ID of their current contents.
     """
-    name = "Checkpatch"
-    doc = "See https://docs.zephyrproject.org/latest/contribute/guidelines.html#coding-style for more details."
-    path_hint = "<git-top>"
-
-    def run(self):
-        checkpatch = os.path.join(BRIDLE_BASE, 'scripts', 'checkpatch.pl')
-        if not os.path.exists(checkpatch):
-            self.skip(f'{checkpatch} not found')
+    # The regex uses word boundaries (\b) to isolate the reference, and
+    # negative lookahead to automatically whitelist the following:
+    #
+    #  - ##, for token pasting (CONFIG_FOO_##X)
+    #
+    #  - $, e.g. for CMake variable expansion (CONFIG_FOO_${VAR})
+    #
+    #  - @, e.g. for CMakes's configure_file() (CONFIG_FOO_@VAR@)
+    #
+    #  - {, e.g. for Python scripts ("CONFIG_FOO_{}_BAR".format(...)")
+    #
+    #  - *, meant for comments like '#endif /* CONFIG_FOO_* */
+    #
+    # Warning: Needs to work with both --perl-regexp and the 're' module
+    REGEX = r"\bCONFIG_[A-Z0-9_]+\b(?!\s*##|[$@{(.*])"
+
+    # Skip doc/releases and doc/security/vulnerabilities.rst, which often
+    # reference removed symbols
+    PATHSPECS = (".", ":!/doc/releases", ":!/doc/security/vulnerabilities.rst")
+
+    # Above this many files to search, a single 'git grep' over the whole
+    # tree is used instead of passing the files on the command line
+    MAX_GREP_PATHS = 1000
+
+    def __init__(self, root, cache_dir=None):
+        self.root = root
+        self.file = None
+        if cache_dir:
+            key = hashlib.sha256(f"{os.path.abspath(root)}\0{self.REGEX}"
+                                 .encode("utf-8")).hexdigest()[:16]
+            self.file = os.path.join(cache_dir, "config-refs",
+                                     f"index-{key}.pickle")
+
+    def refs(self, paths=None):
+        """
+        Returns a dict that maps the names of all referenced symbols (with no
+        'CONFIG_' prefix) to lists of "<path>:<linenr>" strings, in file and
+        line order. 'paths' limits the search to the given files (relative to
+        'root').
+        """
+        files = self._files()
+        if paths is not None:
+            paths = set(paths)
+            files = [(path, blob) for path, blob in files if path in paths]
+
+        blobs = self._load()
+        new = [(path, blob) for path, blob in files if blob not in blobs]
+        if new:
+            if len(new) > self.MAX_GREP_PATHS:
+                found = self._grep(self.PATHSPECS)
+            else:
+                found = self._grep([f":(literal){path}" for path, _ in new])
 
-        diff = subprocess.Popen(('git', 'diff', '--no-ext-diff', COMMIT_RANGE),
-                                stdout=subprocess.PIPE,
-                                cwd=GIT_TOP)
-        try:
-            subprocess.run((checkpatch, '--mailback', '--no-tree', '-'),
-                           check=True,
-                           stdin=diff.stdout,
-                           stdout=subprocess.PIPE,
-                           stderr=subprocess.STDOUT,
-                           shell=True, cwd=GIT_TOP)
+            for path, blob in new:
+                blobs[blob] = tuple(found.get(path, ()))
 
-        except subprocess.CalledProcessError as ex:
-            output = ex.output.decode("utf-8")
-            regex = r'^\s*\S+:(\d+):\s*(ERROR|WARNING):(.+?):(.+)(?:\n|\r\n?)+' \
-                    r'^\s*#(\d+):\s*FILE:\s*(.+):(\d+):'
+            if paths is None:
+                # Only keep the blobs in the current tree
+                blobs = {blob: blobs[blob] for _, blob in files}
+            self._store(blobs)
 
-            matches = re.findall(regex, output, re.MULTILINE)
+        sym_to_locs = collections.defaultdict(list)
+        for path, blob in files:
+            for linenr, sym_name in blobs[blob]:
+                sym_to_locs[sym_name].append(f"{path}:{linenr}")
 
-            # add a guard here for excessive number of errors, do not try and
-            # process each one of them and instead push this as one failure.
-            if len(matches) > 500:
-                self.failure(output)
-                return
+        return sym_to_locs
 
-            for m in matches:
-                self.fmtd_failure(m[1].lower(), m[2], m[5], m[6], col=None,
-                        desc=m[3])
+    def _files(self):
+        # Returns a list of (<path>, <blob ID>) tuples for the files to search,
+        # in 'git ls-files' order
 
-            # If the regex has not matched add the whole output as a failure
-            if len(matches) == 0:
-                self.failure(output)
+        modified = set(git("ls-files", "-z", "--modified", "--",
+                           *self.PATHSPECS, cwd=self.root).split("\0"))
 
+        files = []
+        seen = set()
+        for entry in git("ls-files", "-z", "--stage", "--", *self.PATHSPECS,
+                         cwd=self.root).split("\0"):
+            if not entry:
+                continue
 
-class BoardYmlCheck(ComplianceTest):
-    """
-    Check the board.yml files
-    """
-    name = "BoardYml"
-    doc = "Check the board.yml file format"
-    path_hint = "<zephyr-base>"
+            # <mode> <blob ID> <stage>\t<path>
+            info, path = entry.split("\t", 1)
+            mode, blob, _ = info.split()
 
-    def check_board_file(self, file, vendor_prefixes):
-        """Validate a single board file."""
-        with open(file) as fp:
-            for line_num, line in enumerate(fp.readlines(), start=1):
-                if "vendor:" in line:
-                    _, vnd = line.strip().split(":", 2)
-                    vnd = vnd.strip()
-                    if vnd not in vendor_prefixes:
-                        desc = f"invalid vendor: {vnd}"
-                        self.fmtd_failure("error", "BoardYml", file, line_num,
-                                          desc=desc)
+            # 'git grep' only searches regular files, and each path once (there
+            # are several entries for paths with merge conflicts)
+            if mode not in ("100644", "100755") or path in seen:
+                continue
+            seen.add(path)
 
-    def run(self):
-        vendor_prefixes = ["others"]
-        with open(os.path.join(ZEPHYR_BASE, "dts", "bindings", "vendor-prefixes.txt")) as fp:
-            for line in fp.readlines():
-                line = line.strip()
-                if not line or line.startswith("#"):
+            if path in modified:
+                full_path = os.path.join(self.root, path)
+                if not os.path.isfile(full_path):
+                    # Deleted in the working tree
                     continue
-                try:
-                    vendor, _ = line.split("\t", 2)
-                    vendor_prefixes.append(vendor)
-                except ValueError:
-                    self.error(f"Invalid line in vendor-prefixes.txt:\"{line}\".")
-                    self.error("Did you forget the tab character?")
+                with open(full_path, "rb") as f:
+                    data = f.read()
+                blob = hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
 
-        path = Path(ZEPHYR_BASE)
-        for file in path.glob("**/board.yml"):
-            self.check_board_file(file, vendor_prefixes)
+            files.append((path, blob))
 
+        return files
 
-class ClangFormatCheck(ComplianceTest):
-    """
-    Check if clang-format reports any issues
-    """
-    name = "ClangFormat"
-    doc = "See https://docs.zephyrproject.org/latest/contribute/guidelines.html#clang-format for more details."
-    path_hint = "<git-top>"
-
-    def run(self):
-        exe = f"clang-format-diff.{'exe' if platform.system() == 'Windows' else 'py'}"
+    def _grep(self, pathspecs):
+        # Searches the files in the working tree that match 'pathspecs' for
+        # symbol references. Returns a dict that maps paths to lists of
+        # (<linenr>, <symbol name>) tuples.
 
-        for file in get_files():
-            if Path(file).suffix not in ['.c', '.h']:
+        # Example output line for a reference to CONFIG_FOO at line 17 of
+        # foo/bar.c:
+        #
+        #   foo/bar.c<null>17<null>#ifdef CONFIG_FOO
+        #
+        # 'git grep --only-matching' would get rid of the surrounding context
+        # ('#ifdef '), but it was added fairly recently (second half of 2018),
+        # so we extract the references from each line ourselves instead.
+        grep_cmd = ("git", "grep", "--line-number", "-I", "--null",
+                    "--perl-regexp", self.REGEX, "--", *pathspecs)
+        cp = run_subprocess(grep_cmd, capture_output=True, cwd=self.root)
+
+        # 'git grep' exits with status 1 if nothing is found
+        if cp.returncode not in (0, 1) or cp.stderr:
+            err(f"'{cmd2str(grep_cmd)}' exited with status {cp.returncode} "
+                f"and/or wrote to stderr.\n"
+                f"==stderr==\n"
+                f"{cp.stderr.decode('utf-8')}\n")
+
+        regex = re.compile(self.REGEX.encode("utf-8"))
+
+        found = collections.defaultdict(list)
+        for grep_line in cp.stdout.split(b"\n"):
+            if not grep_line:
                 continue
 
-            diff = subprocess.Popen(('git', 'diff', '-U0', '--no-color', COMMIT_RANGE, '--', file),
-                                    stdout=subprocess.PIPE,
-                                    cwd=GIT_TOP)
-            try:
-                subprocess.run((exe, '-p1'),
-                               check=True,
-                               stdin=diff.stdout,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT,
-                               cwd=GIT_TOP)
-
-            except subprocess.CalledProcessError as ex:
-                patchset = unidiff.PatchSet.from_string(ex.output, encoding="utf-8")
-                for patch in patchset:
-                    for hunk in patch:
-                        # Strip the before and after context
-                        before = next(i for i,v in enumerate(hunk) if str(v).startswith(('-', '+')))
-                        after = next(i for i,v in enumerate(reversed(hunk)) if str(v).startswith(('-', '+')))
-                        msg = "".join([str(l) for l in hunk[before:-after or None]])
-
-                        # show the hunk at the last line
-                        self.fmtd_failure("notice",
-                                          "You may want to run clang-format on this change",
-                                          file, line=hunk.source_start + hunk.source_length - after,
-                                          desc=f'\r\n{msg}')
+            path, linenr, line = grep_line.split(b"\0", 2)
+            path = path.decode("utf-8")
+            linenr = int(linenr)
 
+            # Extract symbol references (might be more than one) within the
+            # line
+            for sym_name in regex.findall(line):
+                # Strip CONFIG_
+                found[path].append((linenr, sym_name[7:].decode("utf-8")))
 
-class DevicetreeBindingsCheck(ComplianceTest):
-    """
-    Checks if we are introducing any unwanted properties in Devicetree Bindings.
-    """
-    name = "DevicetreeBindings"
-    doc = "See https://docs.zephyrproject.org/latest/build/dts/bindings.html for more details."
-    path_hint = "<zephyr-base>"
+        return found
 
-    def run(self, full=True):
-        dts_bindings = self.parse_dt_bindings()
+    def _load(self):
+        # Returns the index stored on disk, or an empty index
 
-        for dts_binding in dts_bindings:
-            self.required_false_check(dts_binding)
+        if self.file:
+            try:
+                with open(self.file, "rb") as f:
+                    return pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                logger.info(f"Can't load CONFIG_ reference index {self.file}: "
+                            f"{e}")
+        return {}
 
-    def parse_dt_bindings(self):
-        """
-        Returns a list of dts/bindings/**/*.yaml files
-        """
+    def _store(self, blobs):
+        # Atomically stores the index 'blobs' on disk
 
-        dt_bindings = []
-        for file_name in get_files(filter="d"):
-            if 'dts/bindings/' in file_name and file_name.endswith('.yaml'):
-                dt_bindings.append(file_name)
+        if not self.file:
+            return
 
-        return dt_bindings
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        tmp = f"{self.file}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(blobs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.file)
 
-    def required_false_check(self, dts_binding):
-        with open(dts_binding) as file:
-            line_number = 0
-            for line in file:
-                line_number += 1
-                if 'required: false' in line:
-                    self.fmtd_failure(
-                        'warning', 'Devicetree Bindings', dts_binding,
-                        line_number, col=None,
-                        desc="'required: false' is redundant, please remove")
+
+def node_rule(*kinds):
+    """
+    Decorator for KconfigCheck node rules: predicates that are called with a
+    KconfigNode and return True for the nodes a check is interested in (e.g.
+    the nodes that break some rule). 'kinds' are the node kinds ("symbol",
+    "choice", "menu", "comment") to call the predicate for, all by default.
+
+    All node rules are run in a single pass over the tree, see
+    KconfigCheck.visit_nodes(), so adding a rule is cheap.
+    """
+    def decorator(predicate):
+        predicate.node_kinds = kinds or ("symbol", "choice", "menu", "comment")
+        return predicate
+
+    return decorator
 
 
 class KconfigCheck(ComplianceTest):
@@ -363,20 +2282,46 @@ class KconfigCheck(ComplianceTest):
     name = "Kconfig"
     doc = "See https://docs.zephyrproject.org/latest/build/kconfig/tips.html for more details."
     path_hint = "<zephyr-base>"
+    # parse_kconfig() sets os.environ and imports kconfiglib globally
+    isolated = True
+    # Files that affect the Kconfig tree, including the west manifest, which
+    # selects the Zephyr and module revisions
+    inputs = ("*Kconfig*", "*board.yml", "*soc.yml", "*archs.yml",
+              "*dts/bindings/*", "*zephyr/module.yml", "west.yml",
+              "submanifests/*")
+    # True if the test looks for references to undefined symbols outside of
+    # Kconfig files (check_no_undef_outside_kconfig())
+    checks_refs = True
+
+    @classmethod
+    def inputs_changed(cls, files):
+        # Also run if a changed file references Kconfig symbols
+        return super().inputs_changed(files) or \
+            cls.checks_refs and any(b"CONFIG_" in REPO.read(file)
+                                    for file in files if REPO.isfile(file))
 
     def run(self, full=True, no_modules=False, filename="Kconfig", hwm=None):
         self.no_modules = no_modules
 
-        kconf = self.parse_kconfig(filename=filename, hwm=hwm)
-
-        self.check_top_menu_not_too_long(kconf)
-        self.check_no_pointless_menuconfigs(kconf)
-        self.check_no_undef_within_kconfig(kconf)
-        self.check_no_redefined_in_defconfig(kconf)
-        self.check_no_enable_in_boolean_prompt(kconf)
-        self.check_soc_name_sync(kconf)
+        # With --incremental, issues are only reported for the files changed
+        # in the commit range, given as absolute paths. None otherwise.
+        self.changed_files = None
+        if INCREMENTAL:
+            self.changed_files = {os.path.realpath(os.path.join(GIT_TOP, file))
+                                  for file in get_files()}
+        self._in_changed_files = {}
+
+        tree = self.parse_kconfig(filename=filename, hwm=hwm)
+        self.node_matches = self.visit_nodes(tree)
+
+        self.check_top_menu_not_too_long(tree)
+        self.check_no_pointless_menuconfigs(tree)
+        self.check_no_undef_within_kconfig(tree)
+        self.check_no_redefined_in_defconfig(tree)
+        self.check_no_enable_in_boolean_prompt(tree)
+        self.check_soc_name_sync(tree)
         if full:
-            self.check_no_undef_outside_kconfig(kconf)
+            self.check_no_undef_outside_kconfig(tree)
 
     def get_modules(self, modules_file, settings_file):
         """
@@ -398,7 +2343,7 @@ class KconfigCheck(ComplianceTest):
         cmd = [sys.executable, zephyr_module_path,
                '--kconfig-out', modules_file, '--settings-out', settings_file]
         try:
-            subprocess.run(cmd, check=True, stdout=subprocess.PIPE,
+            run_subprocess(cmd, check=True, stdout=subprocess.PIPE,
                            stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as ex:
             self.error(ex.output.decode("utf-8"))
@@ -476,7 +2421,7 @@ class KconfigCheck(ComplianceTest):
         for binding_path in binding_paths:
             cmd.append(binding_path)
         try:
-            subprocess.run(cmd, check=True, stdout=subprocess.PIPE,
+            run_subprocess(cmd, check=True, stdout=subprocess.PIPE,
                            stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as ex:
             self.error(ex.output.decode("utf-8"))
@@ -514,7 +2459,7 @@ class KconfigCheck(ComplianceTest):
 
         This is needed to complete Kconfig sanity tests.
         """
-        sys.path.insert(0, os.path.join(ZEPHYR_BASE, "scripts"))
+        add_sys_path(os.path.join(ZEPHYR_BASE, "scripts"))
         import list_boards
         import list_hardware
 
@@ -586,20 +2531,71 @@ class KconfigCheck(ComplianceTest):
             for arch in v2_archs['archs']:
                 fp.write('source "' + (Path(arch['path']) / 'Kconfig').as_posix() + '"\n')
 
+    def get_module_roots(self, settings_file):
+        """
+        Returns the Zephyr base directory and the board, SoC, DTS, architecture
+        and module roots from the Zephyr module generated settings file
+        'settings_file', i.e. the directories the generated Kconfig files are
+        made from.
+        """
+        roots = {os.path.normpath(ZEPHYR_BASE)}
+        for root in ("board", "soc", "dts", "arch", "module_ext"):
+            roots.update(os.path.normpath(path) for path in
+                         self.get_module_setting_root(root, settings_file))
+        return sorted(roots)
+
     def parse_kconfig(self, filename="Kconfig", hwm=None):
         """
-        Returns a kconfiglib.Kconfig object for the Kconfig files. We reuse
-        this object for all tests to avoid having to reparse for each test.
+        Returns a KconfigTree for the Kconfig files. We reuse this object for
+        all tests to avoid having to reparse for each test.
+
+        Trees and generated Kconfig files are shared with the other Kconfig
+        tests of the run through KCONFIG_SESSION. With --cache-dir, they are
+        also cached on disk (see KconfigCache), and the Kconfig files are only
+        generated and parsed again when their inputs changed.
         """
+        key = (self.no_modules, filename)
+        if key not in KCONFIG_SESSION.trees:
+            KCONFIG_SESSION.trees[key] = self._parse_kconfig(filename)
+        return KCONFIG_SESSION.trees[key]
+
+    def _parse_kconfig(self, filename):
+        # Helper for parse_kconfig(). Parses the Kconfig files, or loads the
+        # tree from the on-disk cache.
+
         # Put the Kconfiglib path first to make sure no local Kconfiglib version is
         # used
         kconfig_path = os.path.join(ZEPHYR_BASE, "scripts", "kconfig")
         if not os.path.exists(kconfig_path):
             self.error(kconfig_path + " not found")
 
-        kconfiglib_dir = tempfile.mkdtemp(prefix="kconfiglib_")
+        cache = None
+        if CACHE_DIR:
+            cache = KconfigCache(CACHE_DIR, filename, self.no_modules)
+            if not cache.enabled:
+                cache = None
+
+        if cache:
+            tree = cache.load_tree()
+            if tree:
+                logger.info(f"Using cached Kconfig tree {cache.tree_file}")
+                return tree
+
+        # Kconfig files generated earlier in this run, for the same modules
+        generated = KCONFIG_SESSION.generated.get(self.no_modules)
+        if generated:
+            kconfiglib_dir, roots = generated
+            generate = False
+        elif cache:
+            kconfiglib_dir = cache.generated_dir
+            generate = not cache.generated_valid()
+            if generate:
+                cache.prepare_generated()
+        else:
+            kconfiglib_dir = KCONFIG_SESSION.mkdtemp()
+            generate = True
 
-        sys.path.insert(0, kconfig_path)
+        add_sys_path(kconfig_path)
         # Import globally so that e.g. kconfiglib.Symbol can be referenced in
         # tests
         global kconfiglib
@@ -616,26 +2612,39 @@ class KconfigCheck(ComplianceTest):
         os.environ["KCONFIG_BINARY_DIR"] = kconfiglib_dir
         os.environ['DEVICETREE_CONF'] = "dummy"
         os.environ['TOOLCHAIN_HAS_NEWLIB'] = "y"
+        # Also set by get_v2_model(), which is skipped for cached files
+        os.environ['HWM_SCHEME'] = 'v2'
 
         # Older name for DEVICETREE_CONF, for compatibility with older Zephyr
         # versions that don't have the renaming
         os.environ["GENERATED_DTS_BOARD_CONF"] = "dummy"
 
-        # For multi repo support
-        self.get_modules(os.path.join(kconfiglib_dir, "Kconfig.modules"),
-                         os.path.join(kconfiglib_dir, "settings_file.txt"))
-        # For Kconfig.dts support
-        self.get_kconfig_dts(os.path.join(kconfiglib_dir, "Kconfig.dts"),
-                             os.path.join(kconfiglib_dir, "settings_file.txt"))
-
-        # To make compliance work with old hw model and HWMv2 simultaneously.
+        settings_file = os.path.join(kconfiglib_dir, "settings_file.txt")
         kconfiglib_boards_dir = os.path.join(kconfiglib_dir, 'boards')
-        os.makedirs(kconfiglib_boards_dir, exist_ok=True)
-        os.makedirs(os.path.join(kconfiglib_dir, 'soc'), exist_ok=True)
-        os.makedirs(os.path.join(kconfiglib_dir, 'arch'), exist_ok=True)
+
+        if generate:
+            # For multi repo support
+            self.get_modules(os.path.join(kconfiglib_dir, "Kconfig.modules"),
+                             settings_file)
+            # For Kconfig.dts support
+            self.get_kconfig_dts(os.path.join(kconfiglib_dir, "Kconfig.dts"),
+                                 settings_file)
+
+            # To make compliance work with old hw model and HWMv2 simultaneously.
+            os.makedirs(kconfiglib_boards_dir, exist_ok=True)
+            os.makedirs(os.path.join(kconfiglib_dir, 'soc'), exist_ok=True)
+            os.makedirs(os.path.join(kconfiglib_dir, 'arch'), exist_ok=True)
 
         os.environ["KCONFIG_BOARD_DIR"] = kconfiglib_boards_dir
-        self.get_v2_model(kconfiglib_dir, os.path.join(kconfiglib_dir, "settings_file.txt"))
+
+        if generate:
+            self.get_v2_model(kconfiglib_dir, settings_file)
+
+        if not generated:
+            roots = self.get_module_roots(settings_file)
+            if cache and generate:
+                cache.store_generated(roots)
+            KCONFIG_SESSION.generated[self.no_modules] = (kconfiglib_dir, roots)
 
         # Tells Kconfiglib to generate warnings for all references to undefined
         # symbols within Kconfig files
@@ -646,15 +2655,125 @@ class KconfigCheck(ComplianceTest):
             # them: so some warnings might get printed
             # twice. "warn_to_stderr=False" could unfortunately cause
             # some (other) warnings to never be printed.
-            return kconfiglib.Kconfig(filename=filename)
+            tree = KconfigTree.from_kconfig(kconfiglib.Kconfig(filename=filename))
         except kconfiglib.KconfigError as e:
             self.failure(str(e))
             raise EndTest
-        finally:
-            # Clean up the temporary directory
-            shutil.rmtree(kconfiglib_dir)
 
-    def get_logging_syms(self, kconf):
+        # The tree can only be stored if it was parsed with the files in the
+        # cache directory
+        if cache and kconfiglib_dir == cache.generated_dir:
+            cache.store_tree(tree, roots)
+
+        return tree
+
+    def in_changed_files(self, filename):
+        """
+        Returns True if issues should be reported for the Kconfig file
+        'filename' (relative to $srctree, or absolute), i.e. if it was changed
+        in the commit range or --incremental isn't used.
+        """
+        if self.changed_files is None:
+            return True
+
+        if filename not in self._in_changed_files:
+            self._in_changed_files[filename] = os.path.realpath(
+                os.path.join(ZEPHYR_BASE, filename)) in self.changed_files
+        return self._in_changed_files[filename]
+
+    def visit_nodes(self, tree):
+        """
+        Runs all node rules (see node_rule()) over the nodes of 'tree', in a
+        single pass. Returns a dict that maps the names of the rules to lists
+        of the nodes they returned True for, in tree order.
+        """
+        kind_to_rules = collections.defaultdict(list)
+        node_matches = {}
+        for name in dir(type(self)):
+            kinds = getattr(getattr(type(self), name), "node_kinds", None)
+            if kinds is not None:
+                node_matches[name] = []
+                for kind in kinds:
+                    kind_to_rules[kind].append(
+                        (getattr(self, name), node_matches[name]))
+
+        for node in tree.nodes:
+            for rule, matches in kind_to_rules[node.kind]:
+                if rule(node):
+                    matches.append(node)
+
+        return node_matches
+
+    def get_nodes(self, rule):
+        # Returns the nodes that the node rule 'rule' (a method) matched in
+        # the tree being checked, limited to the changed files with
+        # --incremental
+
+        nodes = self.node_matches[rule.__name__]
+        if self.changed_files is None:
+            return nodes
+        return [node for node in nodes if self.in_changed_files(node.filename)]
+
+    def get_sample_syms(self):
+        # Returns a (<symbol names>, <logging module names>) tuple with the
+        # names of the symbols defined with 'config FOO'/'menuconfig FOO' and
+        # of the logging modules declared with 'module = FOO' (for the logging
+        # Kconfig template) in Zephyr's samples/ and tests/ folders. Those
+        # define their own Kconfig trees, which aren't parsed.
+        #
+        # Both are found with a single 'git grep'. The result is shared with
+        # the other Kconfig tests of the run, and with --cache-dir also cached
+        # on disk per Zephyr HEAD commit, as long as samples/ and tests/ have
+        # no local changes. The cache files are plain JSON and can be shipped
+        # as build artifacts.
+
+        if KCONFIG_SESSION.sample_syms is not None:
+            return KCONFIG_SESSION.sample_syms
+
+        # Warning: Needs to work with both --perl-regexp and the 're' module.
+        # (?:...) is a non-capturing group.
+        regex = r"^\s*(?:(?:menu)?config\s*([A-Z0-9_]+)|module\s*=\s*([A-Z0-9_]+))\s*(?:#|$)"
+
+        cache_file = None
+        if CACHE_DIR and not git("diff", "--name-only", "HEAD", "--",
+                                 ":samples", ":tests", cwd=ZEPHYR_BASE):
+            head = git("rev-parse", "HEAD", cwd=ZEPHYR_BASE)
+            cache_file = os.path.join(CACHE_DIR, "kconfig-syms",
+                                      f"{head}.json")
+            try:
+                with open(cache_file) as f:
+                    cached = json.load(f)
+                if cached["regex"] == regex:
+                    KCONFIG_SESSION.sample_syms = (set(cached["syms"]),
+                                                   set(cached["modules"]))
+                    return KCONFIG_SESSION.sample_syms
+            except (OSError, ValueError, KeyError) as e:
+                logger.info(f"Can't load cached sample symbols {cache_file}: "
+                            f"{e}")
+
+        # Grep samples/ and tests/ for symbol definitions
+        grep_stdout = git("grep", "-I", "-h", "--perl-regexp", regex, "--",
+                          ":samples", ":tests", cwd=ZEPHYR_BASE)
+
+        syms, modules = set(), set()
+        for sym, module in re.findall(regex, grep_stdout, re.MULTILINE):
+            if sym:
+                syms.add(sym)
+            else:
+                modules.add(module)
+
+        if cache_file:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({"regex": regex, "syms": sorted(syms),
+                           "modules": sorted(modules)}, f)
+            os.replace(tmp, cache_file)
+
+        KCONFIG_SESSION.sample_syms = (syms, modules)
+        return KCONFIG_SESSION.sample_syms
+
+    def get_logging_syms(self, tree):
         # Returns a set() with the names of the Kconfig symbols generated with
         # logging template in samples/tests folders. The Kconfig symbols doesn't
         # include `CONFIG_` and for each module declared there is one symbol
@@ -671,14 +2790,7 @@ class KconfigCheck(ComplianceTest):
             "_LOG_LEVEL_DEFAULT",
         ]
 
-        # Warning: Needs to work with both --perl-regexp and the 're' module.
-        regex = r"^\s*(?:module\s*=\s*)([A-Z0-9_]+)\s*(?:#|$)"
-
-        # Grep samples/ and tests/ for symbol definitions
-        grep_stdout = git("grep", "-I", "-h", "--perl-regexp", regex, "--",
-                          ":samples", ":tests", cwd=ZEPHYR_BASE)
-
-        names = re.findall(regex, grep_stdout, re.MULTILINE)
+        _, names = self.get_sample_syms()
 
         kconf_syms = []
         for name in names:
@@ -687,7 +2799,7 @@ class KconfigCheck(ComplianceTest):
 
         return set(kconf_syms)
 
-    def get_defined_syms(self, kconf):
+    def get_defined_syms(self, tree):
         # Returns a set() with the names of all defined Kconfig symbols (with no
         # 'CONFIG_' prefix). This is complicated by samples and tests defining
         # their own Kconfig trees. For those, just grep for 'config FOO' to find
@@ -695,39 +2807,23 @@ class KconfigCheck(ComplianceTest):
         # the main tree, because some symbols are defined using preprocessor
         # macros.
 
-        # Warning: Needs to work with both --perl-regexp and the 're' module.
-        # (?:...) is a non-capturing group.
-        regex = r"^\s*(?:menu)?config\s*([A-Z0-9_]+)\s*(?:#|$)"
-
-        # Grep samples/ and tests/ for symbol definitions
-        grep_stdout = git("grep", "-I", "-h", "--perl-regexp", regex, "--",
-                          ":samples", ":tests", cwd=ZEPHYR_BASE)
-
-        # Generate combined list of configs and choices from the main Kconfig tree.
-        kconf_syms = kconf.unique_defined_syms + kconf.unique_choices
+        sample_syms, _ = self.get_sample_syms()
 
-        # Symbols from the main Kconfig tree + grepped definitions from samples
-        # and tests
-        return set(
-            [sym.name for sym in kconf_syms]
-            + re.findall(regex, grep_stdout, re.MULTILINE)
-        ).union(self.get_logging_syms(kconf))
+        # Symbols from the main Kconfig tree (configs and choices) + grepped
+        # definitions from samples and tests
+        return tree.defined_syms.union(sample_syms,
+                                       self.get_logging_syms(tree))
 
-    def check_top_menu_not_too_long(self, kconf):
+    def check_top_menu_not_too_long(self, tree):
         """
         Checks that there aren't too many items in the top-level menu (which
         might be a sign that stuff accidentally got added there)
         """
         max_top_items = 50
 
-        n_top_items = 0
-        node = kconf.top_node.list
-        while node:
-            # Only count items with prompts. Other items will never be
-            # shown in the menuconfig (outside show-all mode).
-            if node.prompt:
-                n_top_items += 1
-            node = node.next
+        # Only items with prompts are counted. Other items will never be shown
+        # in the menuconfig (outside show-all mode).
+        n_top_items = tree.n_top_prompts
 
         if n_top_items > max_top_items:
             self.failure(f"""
@@ -736,62 +2832,60 @@ prompts) in the top-level Kconfig menu, found {n_top_items} items. If you're
 deliberately adding new entries, then bump the 'max_top_items' variable in
 {__file__}.""")
 
-    def check_no_redefined_in_defconfig(self, kconf):
+    @node_rule()
+    def is_defined_in_defconfig(self, node):
+        # Node rule for nodes with a prompt or help in defconfig files
+
+        return "defconfig" in node.filename and \
+            (node.prompt is not None or node.has_help)
+
+    def check_no_redefined_in_defconfig(self, tree):
         # Checks that no symbols are (re)defined in defconfigs.
 
-        for node in kconf.node_iter():
-            # 'kconfiglib' is global
-            # pylint: disable=undefined-variable
-            if "defconfig" in node.filename and (node.prompt or node.help):
-                name = (node.item.name if node.item not in
-                        (kconfiglib.MENU, kconfiglib.COMMENT) else str(node))
-                self.failure(f"""
-Kconfig node '{name}' found with prompt or help in {node.filename}.
+        for node in self.get_nodes(self.is_defined_in_defconfig):
+            self.failure(f"""
+Kconfig node '{node.name}' found with prompt or help in {node.filename}.
 Options must not be defined in defconfig files.
 """)
-                continue
 
-    def check_no_enable_in_boolean_prompt(self, kconf):
-        # Checks that boolean's prompt does not start with "Enable...".
+    @node_rule("symbol")
+    def has_enable_prompt(self, node):
+        # Node rule for boolean symbols with a prompt that starts with
+        # "Enable..."
 
-        for node in kconf.node_iter():
-            # skip Kconfig nodes not in-tree (will present an absolute path)
-            if os.path.isabs(node.filename):
-                continue
+        # skip Kconfig nodes not in-tree (will present an absolute path)
+        if os.path.isabs(node.filename):
+            return False
 
-            # 'kconfiglib' is global
-            # pylint: disable=undefined-variable
+        # only process boolean symbols with a prompt
+        if node.type != "bool" or not node.prompt:
+            return False
 
-            # only process boolean symbols with a prompt
-            if (not isinstance(node.item, kconfiglib.Symbol) or
-                node.item.type != kconfiglib.BOOL or
-                not node.prompt or
-                not node.prompt[0]):
-                continue
+        return re.match(r"^[Ee]nable.*", node.prompt) is not None
+
+    def check_no_enable_in_boolean_prompt(self, tree):
+        # Checks that boolean's prompt does not start with "Enable...".
 
-            if re.match(r"^[Ee]nable.*", node.prompt[0]):
-                self.failure(f"""
-Boolean option '{node.item.name}' prompt must not start with 'Enable...'. Please
+        for node in self.get_nodes(self.has_enable_prompt):
+            self.failure(f"""
+Boolean option '{node.name}' prompt must not start with 'Enable...'. Please
 check Kconfig guidelines.
 """)
-                continue
 
-    def check_no_pointless_menuconfigs(self, kconf):
+    @node_rule("symbol")
+    def is_pointless_menuconfig(self, node):
+        # Node rule for 'menuconfig' symbols without children
+
+        # Avoid flagging empty regular menus and choices, in case people do
+        # something with 'osource' (could happen for 'menuconfig' symbols
+        # too, though it's less likely)
+        return node.is_menuconfig and not node.has_children
+
+    def check_no_pointless_menuconfigs(self, tree):
         # Checks that there are no pointless 'menuconfig' symbols without
         # children in the Kconfig files
 
-        bad_mconfs = []
-        for node in kconf.node_iter():
-            # 'kconfiglib' is global
-            # pylint: disable=undefined-variable
-
-            # Avoid flagging empty regular menus and choices, in case people do
-            # something with 'osource' (could happen for 'menuconfig' symbols
-            # too, though it's less likely)
-            if node.is_menuconfig and not node.list and \
-               isinstance(node.item, kconfiglib.Symbol):
-
-                bad_mconfs.append(node)
+        bad_mconfs = self.get_nodes(self.is_pointless_menuconfig)
 
         if bad_mconfs:
             self.failure("""\
@@ -799,22 +2893,46 @@ Found pointless 'menuconfig' symbols without children. Use regular 'config'
 symbols instead. See
 https://docs.zephyrproject.org/latest/build/kconfig/tips.html#menuconfig-symbols.
 
-""" + "\n".join(f"{node.item.name:35} {node.filename}:{node.linenr}"
+""" + "\n".join(f"{node.name:35} {node.filename}:{node.linenr}"
                 for node in bad_mconfs))
 
-    def check_no_undef_within_kconfig(self, kconf):
+    def check_no_undef_within_kconfig(self, tree):
         """
         Checks that there are no references to undefined Kconfig symbols within
         the Kconfig files
         """
-        undef_ref_warnings = "\n\n\n".join(warning for warning in kconf.warnings
-                                           if "undefined symbol" in warning)
+        undef_ref_warnings = [warning for warning in tree.warnings
+                              if "undefined symbol" in warning]
+
+        if self.changed_files is not None:
+            # Only keep warnings for references in the changed files
+            undef_ref_warnings = [
+                warning for warning in undef_ref_warnings
+                if any(self.in_changed_files(filename) for filename in
+                       re.findall(r"^- Referenced at (.+):\d+:$", warning,
+                                  re.MULTILINE))]
+
+        undef_ref_warnings = "\n\n\n".join(undef_ref_warnings)
 
         if undef_ref_warnings:
             self.failure(f"Undefined Kconfig symbols:\n\n {undef_ref_warnings}")
 
-    def check_soc_name_sync(self, kconf):
-        sys.path.insert(0, os.path.join(ZEPHYR_BASE, "scripts"))
+    @node_rule("symbol")
+    def is_soc_symbol(self, node):
+        # Node rule for the definitions of CONFIG_SOC
+
+        return node.name == "SOC"
+
+    def check_soc_name_sync(self, tree):
+        if self.changed_files is not None and \
+           not any(os.path.basename(file) == "soc.yml"
+                   for file in self.changed_files) and \
+           not self.get_nodes(self.is_soc_symbol):
+            # With --incremental, only check if soc.yml files or the CONFIG_SOC
+            # defaults were changed
+            return
+
+        add_sys_path(os.path.join(ZEPHYR_BASE, "scripts"))
         import list_hardware
 
         root_args = argparse.Namespace(**{'soc_roots': [Path(ZEPHYR_BASE)]})
@@ -823,13 +2941,8 @@ https://docs.zephyrproject.org/latest/build/kconfig/tips.html#menuconfig-symbols
         soc_names = {soc.name for soc in v2_systems.get_socs()}
 
         soc_kconfig_names = set()
-        for node in kconf.node_iter():
-            # 'kconfiglib' is global
-            # pylint: disable=undefined-variable
-            if isinstance(node.item, kconfiglib.Symbol) and node.item.name == "SOC":
-                n = node.item
-                for d in n.defaults:
-                    soc_kconfig_names.add(d[0].name)
+        for node in self.node_matches["is_soc_symbol"]:
+            soc_kconfig_names.update(node.defaults)
 
         soc_name_warnings = []
         for name in soc_names:
@@ -844,63 +2957,27 @@ Missing SoC names or CONFIG_SOC vs soc.yml out of sync:
 {soc_name_warning_str}
 ''')
 
-    def check_no_undef_outside_kconfig(self, kconf):
+    def check_no_undef_outside_kconfig(self, tree):
         """
         Checks that there are no references to undefined Kconfig symbols
         outside Kconfig files (any CONFIG_FOO where no FOO symbol exists)
         """
-        # Grep for symbol references.
-        #
-        # Example output line for a reference to CONFIG_FOO at line 17 of
-        # foo/bar.c:
-        #
-        #   foo/bar.c<null>17<null>#ifdef CONFIG_FOO
-        #
-        # 'git grep --only-matching' would get rid of the surrounding context
-        # ('#ifdef '), but it was added fairly recently (second half of 2018),
-        # so we extract the references from each line ourselves instead.
-        #
-        # The regex uses word boundaries (\b) to isolate the reference, and
-        # negative lookahead to automatically whitelist the following:
-        #
-        #  - ##, for token pasting (CONFIG_FOO_##X)
-        #
-        #  - $, e.g. for CMake variable expansion (CONFIG_FOO_${VAR})
-        #
-        #  - @, e.g. for CMakes's configure_file() (CONFIG_FOO_@VAR@)
-        #
-        #  - {, e.g. for Python scripts ("CONFIG_FOO_{}_BAR".format(...)")
-        #
-        #  - *, meant for comments like '#endif /* CONFIG_FOO_* */
-
-        defined_syms = self.get_defined_syms(kconf)
+        defined_syms = self.get_defined_syms(tree)
 
         # Maps each undefined symbol to a list <filename>:<linenr> strings
-        undef_to_locs = collections.defaultdict(list)
+        undef_to_locs = {}
 
-        # Warning: Needs to work with both --perl-regexp and the 're' module
-        regex = r"\bCONFIG_[A-Z0-9_]+\b(?!\s*##|[$@{(.*])"
+        # With --incremental, only look for references in the changed files
+        paths = None if self.changed_files is None else get_files()
 
-        # Skip doc/releases and doc/security/vulnerabilities.rst, which often
-        # reference removed symbols
-        grep_stdout = git("grep", "--line-number", "-I", "--null",
-                          "--perl-regexp", regex, "--", ":!/doc/releases",
-                          ":!/doc/security/vulnerabilities.rst",
-                          cwd=Path(GIT_TOP))
+        refs = ConfigRefIndex(GIT_TOP, CACHE_DIR).refs(paths)
 
-        # splitlines() supports various line terminators
-        for grep_line in grep_stdout.splitlines():
-            path, lineno, line = grep_line.split("\0")
-
-            # Extract symbol references (might be more than one) within the
-            # line
-            for sym_name in re.findall(regex, line):
-                sym_name = sym_name[7:]  # Strip CONFIG_
-                if sym_name not in defined_syms and \
-                   sym_name not in self.UNDEF_KCONFIG_ALLOWLIST and \
-                   not (sym_name.endswith("_MODULE") and sym_name[:-7] in defined_syms):
+        for sym_name, locs in refs.items():
+            if sym_name not in defined_syms and \
+               sym_name not in self.UNDEF_KCONFIG_ALLOWLIST and \
+               not (sym_name.endswith("_MODULE") and sym_name[:-7] in defined_syms):
 
-                    undef_to_locs[sym_name].append(f"{path}:{lineno}")
+                undef_to_locs[sym_name] = locs
 
         if not undef_to_locs:
             return
@@ -1067,6 +3144,7 @@ class KconfigBasicCheck(KconfigCheck):
     name = "KconfigBasic"
     doc = "See https://docs.zephyrproject.org/latest/build/kconfig/tips.html for more details."
     path_hint = "<zephyr-base>"
+    checks_refs = False
 
     def run(self):
         super().run(full=False)
@@ -1080,6 +3158,8 @@ class KconfigBasicNoModulesCheck(KconfigCheck):
     name = "KconfigBasicNoModules"
     doc = "See https://docs.zephyrproject.org/latest/build/kconfig/tips.html for more details."
     path_hint = "<zephyr-base>"
+    checks_refs = False
+
     def run(self):
         super().run(full=False, no_modules=True)
 
@@ -1093,6 +3173,7 @@ class KconfigHWMv2Check(KconfigCheck, ComplianceTest):
     """
     name = "KconfigHWMv2"
     doc = "See https://docs.zephyrproject.org/latest/guides/kconfig/index.html for more details."
+    checks_refs = False
 
     def run(self):
         # Use dedicated Kconfig board / soc v2 scheme file.
@@ -1109,10 +3190,20 @@ class Nits(ComplianceTest):
     name = "Nits"
     doc = "See https://docs.zephyrproject.org/latest/contribute/guidelines.html#coding-style for more details."
     path_hint = "<git-top>"
+    high_signal = True
+    per_file = True
+    inputs = ("*.c", "*.conf", "*.cpp", "*.dts", "*.overlay", "*.h", "*.ld",
+              "*.py", "*.rst", "*.txt", "*.yaml", "*.yml", "*Kconfig*",
+              "*defconfig*", "README", "dts/bindings/*")
 
     def run(self):
-        # Loop through added/modified files
+        # Loop through added/modified files. Only issues on added lines are
+        # reported.
         for fname in get_files(filter="d"):
+            # Files in other encodings are reported by TextEncoding
+            if REPO.charset(fname) not in TextEncoding.ALLOWED_CHARSETS:
+                continue
+
             if "Kconfig" in fname:
                 self.check_kconfig_header(fname)
                 self.check_redundant_zephyr_source(fname)
@@ -1132,12 +3223,12 @@ class Nits(ComplianceTest):
     def check_kconfig_header(self, fname):
         # Checks for a spammy copy-pasted header format
 
-        with open(os.path.join(GIT_TOP, fname), encoding="utf-8") as f:
-            contents = f.read()
+        contents = REPO.text(fname)
 
         # 'Kconfig - yada yada' has a copy-pasted redundant filename at the
         # top. This probably means all of the header was copy-pasted.
-        if re.match(r"\s*#\s*(K|k)config[\w.-]*\s*-", contents):
+        match = re.match(r"\s*#\s*(K|k)config[\w.-]*\s*-", contents)
+        if match and self.added(fname, contents, match.end()):
             self.failure(f"""
 Please use this format for the header in '{fname}' (see
 https://docs.zephyrproject.org/latest/build/kconfig/tips.html#header-comments-and-other-nits):
@@ -1158,14 +3249,18 @@ failure.
         # Checks for 'source "$(ZEPHYR_BASE)/Kconfig[.zephyr]"', which can be
         # be simplified to 'source "Kconfig[.zephyr]"'
 
-        with open(os.path.join(GIT_TOP, fname), encoding="utf-8") as f:
-            # Look for e.g. rsource as well, for completeness
-            match = re.search(
+        # Look for e.g. rsource as well, for completeness
+        contents = REPO.text(fname)
+        for match in re.finditer(
                 r'^\s*(?:o|r|or)?source\s*"\$\(?ZEPHYR_BASE\)?/(Kconfig(?:\.zephyr)?)"',
-                f.read(), re.MULTILINE)
+                contents, re.MULTILINE):
+            if self.added(fname, contents, match.end()):
+                break
+        else:
+            match = None
 
-            if match:
-                self.failure("""
+        if match:
+            self.failure("""
 Redundant 'source "$(ZEPHYR_BASE)/{0}" in '{1}'. Just do 'source "{0}"'
 instead. The $srctree environment variable already points to the Zephyr root,
 and all 'source's are relative to it.""".format(match.group(1), fname))
@@ -1173,28 +3268,39 @@ and all 'source's are relative to it.""".format(match.group(1), fname))
     def check_redundant_document_separator(self, fname):
         # Looks for redundant '...' document separators in bindings
 
-        with open(os.path.join(GIT_TOP, fname), encoding="utf-8") as f:
-            if re.search(r"^\.\.\.", f.read(), re.MULTILINE):
-                self.failure(f"""\
+        contents = REPO.text(fname)
+        if any(self.added(fname, contents, match.start()) for match in
+               re.finditer(r"^\.\.\.", contents, re.MULTILINE)):
+            self.failure(f"""\
 Redundant '...' document separator in {fname}. Binding YAML files are never
 concatenated together, so no document separators are needed.""")
 
     def check_source_file(self, fname):
         # Generic nits related to various source files
 
-        with open(os.path.join(GIT_TOP, fname), encoding="utf-8") as f:
-            contents = f.read()
+        contents = REPO.text(fname)
 
-        if not contents.endswith("\n"):
+        if not contents.endswith("\n") and \
+           self.added(fname, contents, len(contents)):
             self.failure(f"Missing newline at end of '{fname}'. Check your text "
                          f"editor settings.")
 
-        if contents.startswith("\n"):
+        if contents.startswith("\n") and self.added(fname, contents, 0):
             self.failure(f"Please remove blank lines at start of '{fname}'")
 
-        if contents.endswith("\n\n"):
+        if contents.endswith("\n\n") and \
+           self.added(fname, contents, len(contents) - 1):
             self.failure(f"Please remove blank lines at end of '{fname}'")
 
+    @staticmethod
+    def added(fname, contents, pos):
+        # Returns True if the line at index 'pos' in 'contents' (the contents
+        # of 'fname') was added in the commit range
+
+        change = REPO.change(fname)
+        line_no = contents.count("\n", 0, pos) + 1
+        return change is not None and line_no in change.added_lines
+
 
 class GitDiffCheck(ComplianceTest):
     """
@@ -1203,6 +3309,8 @@ class GitDiffCheck(ComplianceTest):
     name = "GitDiffCheck"
     doc = "Git conflict markers and whitespace errors are not allowed in added changes"
     path_hint = "<git-top>"
+    high_signal = True
+    always_run = True
 
     def run(self):
         offending_lines = []
@@ -1210,13 +3318,9 @@ class GitDiffCheck(ComplianceTest):
         # Reason: `--check` is mutually exclusive with `--name-only` and `-s`
         p = re.compile(r"\S+\: .*\.")
 
-        for shaidx in get_shas(COMMIT_RANGE):
-            # Ignore non-zero return status code
-            # Reason: `git diff --check` sets the return code to the number of offending lines
-            diff = git("diff", f"{shaidx}^!", "--check", ignore_non_zero=True)
-
-            lines = p.findall(diff)
-            lines = map(lambda x: f"{shaidx}: {x}", lines)
+        for commit in REPO.commits():
+            lines = p.findall(commit.check)
+            lines = map(lambda x: f"{commit.sha}: {x}", lines)
             offending_lines.extend(lines)
 
         if len(offending_lines) > 0:
@@ -1231,12 +3335,13 @@ class GitLint(ComplianceTest):
     name = "Gitlint"
     doc = "See https://docs.zephyrproject.org/latest/contribute/guidelines.html#commit-guidelines for more details"
     path_hint = "<git-top>"
+    always_run = True
 
     def run(self):
         # By default gitlint looks for .gitlint configuration only in
         # the current directory
         try:
-            subprocess.run('gitlint --commits ' + COMMIT_RANGE,
+            run_subprocess('gitlint --commits ' + COMMIT_RANGE,
                            check=True,
                            stdout=subprocess.PIPE,
                            stderr=subprocess.STDOUT,
@@ -1254,6 +3359,24 @@ class PyLint(ComplianceTest):
     name = "Pylint"
     doc = "See https://www.pylint.org/ for more details"
     path_hint = "<git-top>"
+    per_file = True
+    inputs = ("*.py",)
+
+    # Checks whose messages for a file depend on the other checked files,
+    # e.g. on the code duplicated between them
+    CROSS_FILE_CHECKS = ("duplicate-code", "cyclic-import")
+
+    # Number of files to lint above which the files are spread over a pool
+    # of worker processes. Starting the workers costs more than it saves for
+    # fewer files.
+    MIN_POOL_FILES = 32
+
+    @classmethod
+    def inputs_changed(cls, files):
+        # Also run for Python scripts without a .py extension
+        return super().inputs_changed(files) or \
+            bool(filter_py(GIT_TOP, [file for file in files
+                                     if REPO.isfile(file)]))
 
     def run(self):
         # Path to pylint configuration file
@@ -1274,6 +3397,165 @@ class PyLint(ComplianceTest):
         if not py_files:
             return
 
+        # Replay the issues of files that were checked before with the same
+        # configuration, and only run pylint on the other files
+        config_id = " ".join((file_digest(pylintrc),
+                              dir_digest(check_script_dir),
+                              package_version("pylint")))
+        # pylint checks the files in the working tree, which might not have
+        # the contents of the snapshot, e.g. with --staged. Verdicts are keyed
+        # by the contents that are checked.
+        blobs = {}
+        for file in py_files:
+            try:
+                with open(os.path.join(GIT_TOP, file), "rb") as f:
+                    blobs[file] = git_blob_id(f.read())
+            except OSError:
+                blobs[file] = None
+        verdicts = {file: blobs[file] and
+                          self.get_verdict(file, config_id, blobs[file])
+                    for file in py_files}
+        todo = [file for file in py_files if verdicts[file] is None]
+
+        # The messages of the cross-file checks depend on all the files. They
+        # are cached for the list of files and their contents, so that the
+        # cross-file checks only run again if one of the files changed.
+        cross_file_blob = None
+        if None not in blobs.values():
+            cross_file_blob = git_blob_id("".join(
+                f"{file}\0{blobs[file]}\n" for file in py_files)
+                                          .encode("utf-8"))
+        cross_file_verdict = cross_file_blob and self.get_verdict(
+            "\n".join(py_files), config_id, cross_file_blob)
+        if len(py_files) == 1:
+            # A single file can't import or duplicate another one
+            cross_file_verdict = []
+
+        pylintargs = ["--rcfile=" + pylintrc, "--load-plugins=argparse-checker"]
+        cross_file_checks = ",".join(self.CROSS_FILE_CHECKS)
+
+        with contextlib.ExitStack() as stack:
+            # Spread the files over a pool of worker processes that run
+            # pylint in-process if there are many of them and idle --jobs
+            # slots (see JobSlots). A --serve daemon always uses its pool,
+            # which has pylint imported already.
+            n_chunks = 0
+            if todo:
+                n_chunks = 1
+                if len(todo) > self.MIN_POOL_FILES:
+                    n_chunks = stack.enter_context(
+                        JOB_SLOTS.workers(len(todo)))
+            chunks = [todo[i::n_chunks] for i in range(n_chunks)]
+
+            # (<files>, <extra arguments>, <per-file>, <cross-file>) tuples for
+            # the pylint runs. The messages of the per-file runs are cached
+            # per file. The cross-file checks need all files in a single run.
+            # If all files are checked in one run anyway, the checks are
+            # enabled there. Otherwise, a separate run with just those checks
+            # enabled checks all the files, unless its messages are cached.
+            # That run still parses the files whose messages are cached.
+            if chunks == [py_files] and cross_file_verdict is None:
+                runs = [(py_files, [], True, True)]
+            else:
+                runs = [(chunk, ["--disable=" + cross_file_checks], True, False)
+                        for chunk in chunks]
+                if cross_file_verdict is None:
+                    runs.append((py_files,
+                                 ["--disable=all",
+                                  "--enable=" + cross_file_checks],
+                                 False, True))
+
+            for files, args, _, _ in runs:
+                logger.info(cmd2str(["pylint", *pylintargs, *args, *files]))
+
+            if not runs:
+                results = []
+            elif WARM_CACHE is not None or n_chunks > 1:
+                # pylint's own parallelism ('jobs' in pylintrc) is disabled in
+                # the workers
+                with pylint_pool(config_id) as pool:
+                    results = list(pool.map(
+                        _run_pylint,
+                        [files for files, _, _, _ in runs],
+                        [[*pylintargs, "--jobs=1", *args]
+                         for _, args, _, _ in runs],
+                        itertools.repeat(check_script_dir),
+                        itertools.repeat(GIT_TOP)))
+            else:
+                # Starting the pylint command is cheaper than starting a
+                # worker
+                results = [self.run_pylint_cmd(files, [*pylintargs, *args],
+                                               check_script_dir)
+                           for files, args, _, _ in runs]
+
+        new_verdicts = {}
+        # Messages of the cross-file checks
+        cross_file_messages = []
+        # Messages that aren't cached, e.g. for modules imported by the
+        # checked files
+        uncached = {}
+        outputs = []
+        for (files, _, per_file, cross_file), (messages, output) in \
+                zip(runs, results):
+            if output is not None:
+                # Nothing is cached for the files of a failed run
+                outputs.append(output)
+                cross_file_blob = None
+            elif per_file:
+                for file in files:
+                    new_verdicts[file] = []
+
+            for m in messages:
+                severity = 'unknown'
+                if m['messageId'][0] in ('F', 'E'):
+                    severity = 'error'
+                elif m['messageId'][0] in ('W','C', 'R', 'I'):
+                    severity = 'warning'
+                failure = ("fmtd_failure",
+                           (severity, m['messageId'], m['path'], m['line'],
+                            str(m['column']),
+                            m['message'] + f" ({m['symbol']})"))
+                if m['symbol'] in self.CROSS_FILE_CHECKS:
+                    cross_file_messages.append(failure)
+                elif m['path'] in new_verdicts:
+                    new_verdicts[m['path']].append(failure)
+                else:
+                    uncached.setdefault(m['path'], []).append(failure)
+
+        for file, verdict in new_verdicts.items():
+            if blobs[file]:
+                self.put_verdict(file, config_id, verdict, blobs[file])
+
+        if cross_file_verdict is None:
+            cross_file_verdict = cross_file_messages
+            if cross_file_blob:
+                self.put_verdict("\n".join(py_files), config_id,
+                                 cross_file_verdict, cross_file_blob)
+
+        # Report the cross-file messages along with the other messages for
+        # the same file
+        for failure in cross_file_verdict:
+            uncached.setdefault(failure[1][2], []).append(failure)
+
+        for file in py_files:
+            if verdicts[file] is not None:
+                self.replay(verdicts[file])
+            else:
+                self.replay(new_verdicts.get(file, []))
+            self.replay(uncached.pop(file, []))
+        for verdict in uncached.values():
+            self.replay(verdict)
+
+        if outputs:
+            # If pylint failed without specific messages, add its whole
+            # output as a failure
+            self.failure("\n".join(dict.fromkeys(outputs)))
+
+    @staticmethod
+    def run_pylint_cmd(files, args, check_script_dir):
+        # Runs the pylint command with the arguments 'args' on 'files'.
+        # Returns the same as _run_pylint().
+
         python_environment = os.environ.copy()
         if "PYTHONPATH" in python_environment:
             python_environment["PYTHONPATH"] = check_script_dir + ":" + \
@@ -1281,11 +3563,9 @@ class PyLint(ComplianceTest):
         else:
             python_environment["PYTHONPATH"] = check_script_dir
 
-        pylintcmd = ["pylint", "--output-format=json2", "--rcfile=" + pylintrc,
-                     "--load-plugins=argparse-checker"] + py_files
-        logger.info(cmd2str(pylintcmd))
+        pylintcmd = ["pylint", "--output-format=json2", *args, *files]
         try:
-            subprocess.run(pylintcmd,
+            run_subprocess(pylintcmd,
                            check=True,
                            stdout=subprocess.PIPE,
                            stderr=subprocess.STDOUT,
@@ -1293,33 +3573,106 @@ class PyLint(ComplianceTest):
                            env=python_environment)
         except subprocess.CalledProcessError as ex:
             output = ex.output.decode("utf-8")
-            messages = json.loads(output)['messages']
-            for m in messages:
-                severity = 'unknown'
-                if m['messageId'][0] in ('F', 'E'):
-                    severity = 'error'
-                elif m['messageId'][0] in ('W','C', 'R', 'I'):
-                    severity = 'warning'
-                self.fmtd_failure(severity, m['messageId'], m['path'],
-                                  m['line'], col=str(m['column']), desc=m['message']
-                                  + f" ({m['symbol']})")
+            try:
+                messages = json.loads(output)['messages']
+            except ValueError:
+                messages = []
+
+            if not messages:
+                return [], output
+            return messages, None
 
-            if len(messages) == 0:
-                # If there are no specific messages add the whole output as a failure
-                self.failure(output)
+        return [], None
+
+
+def _run_pylint(files, args, check_script_dir, cwd):
+    # PyLint check helper. Runs pylint with the arguments 'args' on 'files'
+    # (relative to 'cwd') in a worker process of pylint_pool(). Returns a
+    # (<messages>, <output>) tuple, where <messages> has the messages as dicts
+    # in the --output-format=json2 format. <output> is what pylint printed if
+    # it failed without reporting any messages, and None otherwise.
+
+    # For the argparse-checker plugin
+    add_sys_path(check_script_dir)
+    os.chdir(cwd)
+
+    import astroid
+    from pylint.lint import Run
+    from pylint.reporters import JSON2Reporter
+
+    # Workers are reused, so don't let astroid return modules parsed from
+    # older versions of the files
+    astroid.MANAGER.clear_cache()
+
+    report = io.StringIO()
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), \
+             contextlib.redirect_stderr(output):
+            run = Run([*args, *files], reporter=JSON2Reporter(report),
+                      exit=False)
+        status = run.linter.msg_status
+    except SystemExit as e:
+        # E.g. for an invalid pylintrc
+        status = e.code
+    except Exception:
+        output.write(traceback.format_exc())
+        status = 1
+
+    try:
+        messages = json.loads(report.getvalue())["messages"]
+    except ValueError:
+        messages = []
+
+    if status and not messages:
+        return [], output.getvalue() or f"pylint failed with status {status}"
+    return messages, None
+
+
+@contextlib.contextmanager
+def pylint_pool(config_id):
+    # PyLint check helper. Returns a context manager for an executor with
+    # JOBS spawned worker processes for _run_pylint(). A --serve daemon keeps
+    # the workers, with pylint already imported, between runs, as long as the
+    # pylint configuration, identified by 'config_id', doesn't change.
+
+    global PYLINT_POOL
+
+    if WARM_CACHE is None:
+        with ProcessPoolExecutor(
+                max_workers=JOBS,
+                mp_context=multiprocessing.get_context("spawn")) as pool:
+            yield pool
+        return
+
+    with PYLINT_POOL_LOCK:
+        if PYLINT_POOL and PYLINT_POOL[0] != (config_id, JOBS):
+            PYLINT_POOL[1].shutdown()
+            PYLINT_POOL = None
+        if not PYLINT_POOL:
+            PYLINT_POOL = ((config_id, JOBS), ProcessPoolExecutor(
+                max_workers=JOBS,
+                mp_context=multiprocessing.get_context("spawn")))
+        yield PYLINT_POOL[1]
+
+
+# ((<pylint configuration>, <number of workers>), <executor>) for the pylint
+# workers of a --serve daemon, or None. See pylint_pool().
+PYLINT_POOL = None
+PYLINT_POOL_LOCK = threading.Lock()
 
 
 def filter_py(root, fnames):
     # PyLint check helper. Returns all Python script filenames among the
     # filenames in 'fnames', relative to directory 'root'.
     #
-    # Uses the python-magic library, so that we can detect Python
-    # files that don't end in .py as well. python-magic is a frontend
-    # to libmagic, which is also used by 'file'.
+    # Uses RepoSnapshot.mime(), so that we can detect Python files that
+    # don't end in .py as well, from their shebang line. Newer versions of
+    # libmagic (used for unusual files) report "text/x-script.python".
     return [fname for fname in fnames
             if (fname.endswith(".py") or
-             magic.from_file(os.path.join(root, fname),
-                             mime=True) == "text/x-python")]
+             REPO.mime(fname).split(";")[0] in ("text/x-python",
+                                                "text/x-script.python"))]
 
 
 class Identity(ComplianceTest):
@@ -1331,25 +3684,15 @@ class Identity(ComplianceTest):
     # git rev-list and git log don't depend on the current (sub)directory
     # unless explicited
     path_hint = "<git-top>"
+    high_signal = True
+    always_run = True
 
     def run(self):
-        for shaidx in get_shas(COMMIT_RANGE):
-            commit = git("log", "--decorate=short", "-n 1", shaidx)
-            signed = []
-            author = ""
-            sha = ""
-            parsed_addr = None
-            for line in commit.split("\n"):
-                match = re.search(r"^commit\s([^\s]*)", line)
-                if match:
-                    sha = match.group(1)
-                match = re.search(r"^Author:\s(.*)", line)
-                if match:
-                    author = match.group(1)
-                    parsed_addr = parseaddr(author)
-                match = re.search(r"signed-off-by:\s(.*)", line, re.IGNORECASE)
-                if match:
-                    signed.append(match.group(1))
+        for commit in REPO.commits():
+            sha = commit.sha
+            author = commit.author
+            parsed_addr = parseaddr(author)
+            signed = commit.signed_off_by
 
             error1 = f"{sha}: author email ({author}) needs to match one of " \
                      f"the signed-off-by entries."
@@ -1381,16 +3724,17 @@ class BinaryFiles(ComplianceTest):
     name = "BinaryFiles"
     doc = "No binary files allowed."
     path_hint = "<git-top>"
+    high_signal = True
+    inputs = ("*",)
 
     def run(self):
         BINARY_ALLOW_PATHS = ("doc/", "boards/", "samples/")
         # svg files are always detected as binary, see .gitattributes
         BINARY_ALLOW_EXT = (".bmp", ".fzpz", ".fzz", ".gif", ".jpg", ".jpeg", ".pdf", ".png", ".svg", ".webp")
 
-        for stat in git("diff", "--numstat", "--diff-filter=A",
-                        COMMIT_RANGE).splitlines():
-            added, deleted, fname = stat.split("\t")
-            if added == "-" and deleted == "-":
+        for change in REPO.changes().values():
+            if change.status == "A" and change.binary:
+                fname = change.path
                 if (fname.startswith(BINARY_ALLOW_PATHS) and
                     fname.endswith(BINARY_ALLOW_EXT)):
                     continue
@@ -1404,19 +3748,17 @@ class ImageSize(ComplianceTest):
     name = "ImageSize"
     doc = "Check the size of image files."
     path_hint = "<git-top>"
+    inputs = ("*",)
 
     def run(self):
         SIZE_LIMIT = 250 << 10
         BOARD_SIZE_LIMIT = 2500 << 10
 
         for file in get_files(filter="d"):
-            full_path = os.path.join(GIT_TOP, file)
-            mime_type = magic.from_file(full_path, mime=True)
-
-            if not mime_type.startswith("image/"):
+            if not REPO.mime(file).startswith("image/"):
                 continue
 
-            size = os.path.getsize(full_path)
+            size = len(REPO.read(file))
 
             limit = SIZE_LIMIT
             if file.startswith("boards/"):
@@ -1434,10 +3776,11 @@ class MaintainersFormat(ComplianceTest):
     name = "MaintainersFormat"
     doc = "Check that MAINTAINERS file parses correctly."
     path_hint = "<git-top>"
+    inputs = ("MAINTAINERS.yml", "MAINTAINERS.yaml")
 
     def run(self):
-        sys.path.insert(0, os.path.join(ZEPHYR_BASE, "scripts"))
-        from get_maintainer import Maintainers, MaintainersError
+        add_sys_path(os.path.join(ZEPHYR_BASE, "scripts"))
+        from get_maintainer import MaintainersError
 
         MAINTAINERS_FILES = ["MAINTAINERS.yml", "MAINTAINERS.yaml"]
 
@@ -1446,10 +3789,21 @@ class MaintainersFormat(ComplianceTest):
                 continue
 
             try:
-                Maintainers(file)
+                load_maintainers(file)
             except MaintainersError as ex:
                 self.failure(f"Error parsing {file}: {ex}")
 
+
+def load_maintainers(path):
+    # Returns a get_maintainer.Maintainers instance for the MAINTAINERS file
+    # 'path'. Raises get_maintainer.MaintainersError for invalid files.
+
+    from get_maintainer import Maintainers
+
+    return warm(("maintainers", os.path.abspath(path)), [path],
+                lambda: Maintainers(path))
+
+
 class ModulesMaintainers(ComplianceTest):
     """
     Check that all modules have a MAINTAINERS entry.
@@ -1457,10 +3811,12 @@ class ModulesMaintainers(ComplianceTest):
     name = "ModulesMaintainers"
     doc = "Check that all modules have a MAINTAINERS entry."
     path_hint = "<git-top>"
+    inputs = ("MAINTAINERS.yml", "MAINTAINERS.yaml", "west.yml",
+              "submanifests/*")
 
     def run(self):
-        sys.path.insert(0, os.path.join(ZEPHYR_BASE, "scripts"))
-        from get_maintainer import Maintainers, MaintainersError
+        add_sys_path(os.path.join(ZEPHYR_BASE, "scripts"))
+        from get_maintainer import MaintainersError
 
         MAINTAINERS_FILES = ["MAINTAINERS.yml", "MAINTAINERS.yaml"]
 
@@ -1475,9 +3831,10 @@ class ModulesMaintainers(ComplianceTest):
             return
 
         try:
-            maintainers = Maintainers(maintainers_file)
+            maintainers = load_maintainers(maintainers_file)
         except MaintainersError as ex:
-            self.failure(f"Error parsing {file}: {ex}")
+            self.failure(f"Error parsing {maintainers_file}: {ex}")
+            return
 
         for project in manifest.get_projects([]):
             if not manifest.is_active(project):
@@ -1498,27 +3855,107 @@ class YAMLLint(ComplianceTest):
     name = "YAMLLint"
     doc = "Check YAML files with YAMLLint."
     path_hint = "<git-top>"
+    per_file = True
+    inputs = ("*.yaml", "*.yml", ".yamllint")
+
+    # Number of files to lint above which the files are spread over a pool
+    # of worker processes
+    MIN_POOL_FILES = 64
 
     def run(self):
         config_file = os.path.join(BRIDLE_BASE, ".yamllint")
+        config_id = f"{file_digest(config_file)} {package_version('yamllint')}"
+        configs = warm(("yamllint", config_file), [config_file],
+                       lambda: self.load_configs(config_file))
+
+        files = [file for file in get_files(filter="d")
+                 if Path(file).suffix in ['.yaml', '.yml']]
+
+        # Only lint the files without cached issues
+        verdicts = {file: self.get_verdict(file, config_id) for file in files}
+        todo = [file for file in files if verdicts[file] is None]
+
+        with contextlib.ExitStack() as stack:
+            # Use a pool if there are many files and idle --jobs slots (see
+            # JobSlots)
+            n_workers = 1
+            if len(todo) > self.MIN_POOL_FILES:
+                n_workers = stack.enter_context(JOB_SLOTS.workers(JOBS))
+
+            if n_workers > 1:
+                pool = stack.enter_context(ProcessPoolExecutor(
+                    max_workers=n_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_yamllint_worker, initargs=(configs,)))
+                # Linting a file is quick, so send the files in chunks
+                results = pool.map(
+                    _run_yamllint, todo, map(REPO.text, todo),
+                    chunksize=max(1, len(todo) // (4 * n_workers)))
+            else:
+                results = (lint_yaml(configs, file, REPO.text(file))
+                           for file in todo)
+
+            # Report the issues in file order, as the results come in
+            for file in files:
+                verdict = verdicts[file]
+                if verdict is None:
+                    verdict = [("fmtd_failure",
+                                ('warning', f'YAMLLint ({rule})', file, line,
+                                 col, desc))
+                               for rule, line, col, desc in next(results)]
+                    self.put_verdict(file, config_id, verdict)
+                self.replay(verdict)
+
+    @staticmethod
+    def load_configs(config_file):
+        # Returns a dict with the YamlLintConfig to use for each kind of file,
+        # for lint_yaml(). Parses 'config_file' (the .yamllint file) just once.
+
+        base = config.YamlLintConfig(file=config_file)
+
+        # Tweak few rules for workflow files.
+        github = copy.deepcopy(base)
+        github.rules["line-length"] = False
+        github.rules["truthy"]["allowed-values"].extend(['on', 'off'])
+
+        codecov = copy.deepcopy(base)
+        codecov.rules["truthy"]["allowed-values"].extend(['yes', 'no'])
+
+        return {"": base, ".github/": github, ".codecov.yml": codecov}
+
+
+def lint_yaml(configs, file, text):
+    # YAMLLint check helper. Lints 'text', the contents of 'file', with the
+    # matching configuration in 'configs' (see YAMLLint.load_configs()).
+    # Returns a (<rule>, <line>, <column>, <description>) tuple per problem.
+
+    if file.startswith(".github/"):
+        yaml_config = configs[".github/"]
+    elif file == ".codecov.yml":
+        yaml_config = configs[".codecov.yml"]
+    else:
+        yaml_config = configs[""]
 
-        for file in get_files(filter="d"):
-            if Path(file).suffix not in ['.yaml', '.yml']:
-                continue
+    return [(p.rule, p.line, p.column, p.desc)
+            for p in linter.run(text, yaml_config)]
+
+
+def _init_yamllint_worker(configs):
+    # Initializer for the worker processes of YAMLLint. Keeps the parsed
+    # configurations, so that they're only sent once per worker.
+
+    global YAMLLINT_CONFIGS
+    YAMLLINT_CONFIGS = configs
 
-            yaml_config = config.YamlLintConfig(file=config_file)
 
-            if file.startswith(".github/"):
-                # Tweak few rules for workflow files.
-                yaml_config.rules["line-length"] = False
-                yaml_config.rules["truthy"]["allowed-values"].extend(['on', 'off'])
-            elif file == ".codecov.yml":
-                yaml_config.rules["truthy"]["allowed-values"].extend(['yes', 'no'])
+def _run_yamllint(file, text):
+    # Runs lint_yaml() in a worker process of YAMLLint
 
-            with open(file, 'r') as fp:
-                for p in linter.run(fp, yaml_config):
-                    self.fmtd_failure('warning', f'YAMLLint ({p.rule})', file,
-                                      p.line, col=p.column, desc=p.desc)
+    return lint_yaml(YAMLLINT_CONFIGS, file, text)
+
+
+# The YAMLLint configurations in a YAMLLint worker process
+YAMLLINT_CONFIGS = None
 
 
 class SphinxLint(ComplianceTest):
@@ -1529,39 +3966,115 @@ class SphinxLint(ComplianceTest):
     name = "SphinxLint"
     doc = "Check Sphinx/reStructuredText files with sphinx-lint."
     path_hint = "<git-top>"
+    inputs = ("*.rst",)
 
     # Checkers added/removed to sphinx-lint's default set
     DISABLE_CHECKERS = ["horizontal-tab", "missing-space-before-default-role"]
     ENABLE_CHECKERS = ["default-role"]
 
     def run(self):
-        for file in get_files():
-            if not file.endswith(".rst"):
-                continue
+        files = [file for file in get_files() if file.endswith(".rst")]
+        if not files:
+            return
 
-            try:
-                # sphinx-lint does not expose a public API so interaction is done via CLI
-                subprocess.run(
-                    f"sphinx-lint -d {','.join(self.DISABLE_CHECKERS)} -e {','.join(self.ENABLE_CHECKERS)} {file}",
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    shell=True,
-                    cwd=GIT_TOP,
-                )
+        api = self.load_api()
+        if api is None:
+            self.run_cli(files)
+            return
+
+        check_text, checkers, caches = api
+        config_id = f"{self.DISABLE_CHECKERS} {self.ENABLE_CHECKERS} " \
+                    f"{package_version('sphinx-lint')}"
+
+        for file in files:
+            self.cached_check(
+                file, config_id,
+                lambda: self.check_file(file, check_text, checkers, caches))
+
+    @classmethod
+    def load_api(cls):
+        # Returns a (<check_text()>, <checkers>, <per-file caches>) tuple for
+        # running sphinx-lint in-process, or None if the installed sphinx-lint
+        # doesn't have them. sphinx-lint has no public API, so these are
+        # internals that might change between versions. <checkers> are the
+        # checkers sphinx-lint enables by default, adjusted as with its
+        # --disable and --enable options.
+
+        try:
+            from sphinxlint import check_text
+            from sphinxlint.checkers import all_checkers
+            from sphinxlint.utils import PER_FILE_CACHES
+
+            checkers = {checker for name, checker in all_checkers.items()
+                        if (checker.enabled or name in cls.ENABLE_CHECKERS)
+                        and name not in cls.DISABLE_CHECKERS}
+            caches = list(PER_FILE_CACHES)
+        except (ImportError, AttributeError, TypeError):
+            return None
+
+        return check_text, checkers, caches
+
+    def run_cli(self, files):
+        # Runs the sphinx-lint command on 'files', as the fallback for
+        # versions of sphinx-lint that can't be run in-process. The command
+        # reads the files in the working tree.
+
+        if importlib.util.find_spec("sphinxlint"):
+            cmd = [sys.executable, "-m", "sphinxlint"]
+        elif shutil.which("sphinx-lint"):
+            cmd = ["sphinx-lint"]
+        else:
+            self.skip("sphinx-lint is not installed")
+
+        cmd += ["-d", ",".join(self.DISABLE_CHECKERS),
+                "-e", ",".join(self.ENABLE_CHECKERS), *files]
+        logger.info(cmd2str(cmd))
+        cp = run_subprocess(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, cwd=GIT_TOP)
+        output = cp.stdout.decode("utf-8", "replace")
+
+        n_errors = 0
+        for line in output.splitlines():
+            match = re.match(r"^(.*):(\d+): (.*)$", line)
+            if match:
+                self.fmtd_failure("error", "SphinxLint", match.group(1),
+                                  int(match.group(2)), desc=match.group(3))
+                n_errors += 1
+
+        # If sphinx-lint failed without reporting errors, add its whole
+        # output as a failure
+        if cp.returncode and not n_errors:
+            self.failure(output)
 
-            except subprocess.CalledProcessError as ex:
-                for line in ex.output.decode("utf-8").splitlines():
-                    match = re.match(r"^(.*):(\d+): (.*)$", line)
+    def check_file(self, file, check_text, checkers, caches):
+        # Runs the sphinx-lint checkers in 'checkers' on 'file', using
+        # sphinx-lint's check_text(). 'caches' are sphinx-lint's per-file
+        # caches, which its own check_file() clears after each file.
 
-                    if match:
-                        self.fmtd_failure(
-                            "error",
-                            "SphinxLint",
-                            match.group(1),
-                            int(match.group(2)),
-                            desc=match.group(3),
-                        )
+        try:
+            text = REPO.text(file)
+        except UnicodeDecodeError as e:
+            self.fmtd_failure("error", "SphinxLint", file,
+                              desc=f"cannot decode as UTF-8: {e}")
+            return
+
+        try:
+            errors = check_text(file, text, checkers)
+            errors = [(error.line_no, f"{error.msg} ({error.checker_name})")
+                      for error in errors]
+        except (AttributeError, TypeError) as e:
+            # The sphinx-lint internals changed in a way that load_api()
+            # can't tell. Fail rather than skip, so that it gets noticed.
+            self.failure(f"sphinx-lint {package_version('sphinx-lint')} "
+                         f"can't be run in-process: {e}",
+                         msg="incompatible sphinx-lint")
+            raise EndTest
+        finally:
+            for cache in caches:
+                cache.cache_clear()
+
+        for line_no, desc in errors:
+            self.fmtd_failure("error", "SphinxLint", file, line_no, desc=desc)
 
 
 class KeepSorted(ComplianceTest):
@@ -1571,6 +4084,8 @@ class KeepSorted(ComplianceTest):
     name = "KeepSorted"
     doc = "Check for blocks of code or config that should be kept sorted."
     path_hint = "<git-top>"
+    per_file = True
+    inputs = ("*",)
 
     MARKER = "zephyr-keep-sorted"
 
@@ -1589,12 +4104,21 @@ class KeepSorted(ComplianceTest):
 
         return True
 
-    def check_file(self, file, fp):
-        mime_type = magic.from_file(file, mime=True)
+    def check_file(self, file):
+        # Only issues in blocks with added lines are reported
 
-        if not mime_type.startswith("text/"):
+        # Files in other encodings are reported by TextEncoding
+        if not REPO.mime(file).startswith("text/") or \
+           REPO.charset(file) not in TextEncoding.ALLOWED_CHARSETS:
             return
 
+        change = REPO.change(file)
+        added_lines = change.added_lines if change else frozenset()
+
+        def added(first, last):
+            # True if a line in the range 'first' to 'last' was added
+            return any(first <= line_no <= last for line_no in added_lines)
+
         block_data = ""
         in_block = False
 
@@ -1602,10 +4126,12 @@ class KeepSorted(ComplianceTest):
         stop_marker = f"{self.MARKER}-stop"
         start_line = None
         stop_line = None
+        line_num = 0
 
-        for line_num, line in enumerate(fp.readlines(), start=1):
+        # io.StringIO() splits on "\n" only, like file.readlines()
+        for line_num, line in enumerate(io.StringIO(REPO.text(file)), start=1):
             if start_marker in line:
-                if in_block:
+                if in_block and added(start_line - 1, line_num):
                     desc = f"nested {start_marker}"
                     self.fmtd_failure("error", "KeepSorted", file, line_num,
                                      desc=desc)
@@ -1613,31 +4139,36 @@ class KeepSorted(ComplianceTest):
                 block_data = ""
                 start_line = line_num + 1
             elif stop_marker in line:
-                if not in_block:
+                if not in_block and line_num in added_lines:
                     desc = f"{stop_marker} without {start_marker}"
                     self.fmtd_failure("error", "KeepSorted", file, line_num,
                                      desc=desc)
-                in_block = False
                 stop_line = line_num - 1
 
-                if not self.block_is_sorted(block_data):
+                if in_block and added(start_line - 1, line_num) and \
+                   not self.block_is_sorted(block_data):
                     desc = (f"sorted block is not sorted, sort by running: " +
                             f"\"ex -s -c '{start_line},{stop_line} sort i|x' {file}\"")
                     self.fmtd_failure("error", "KeepSorted", file, line_num,
                                       desc=desc)
+                in_block = False
             elif not line.strip() or line.startswith("#"):
                 # Ignore comments and blank lines
                 continue
             elif in_block:
                 block_data += line
 
-        if in_block:
+        if in_block and added(start_line - 1, line_num):
             self.failure(f"unterminated {start_marker} in {file}")
 
     def run(self):
         for file in get_files(filter="d"):
-            with open(file, "r") as fp:
-                self.check_file(file, fp)
+            # Only blocks with added lines are checked, so the cached issues
+            # depend on them too
+            change = REPO.change(file)
+            added_lines = sorted(change.added_lines) if change else []
+            self.cached_check(file, " ".join(map(str, added_lines)),
+                              lambda: self.check_file(file))
 
 
 class TextEncoding(ComplianceTest):
@@ -1647,21 +4178,20 @@ class TextEncoding(ComplianceTest):
     name = "TextEncoding"
     doc = "Check the encoding of text files."
     path_hint = "<git-top>"
+    per_file = True
+    inputs = ("*",)
 
     ALLOWED_CHARSETS = ["us-ascii", "utf-8"]
 
     def run(self):
-        m = magic.Magic(mime=True, mime_encoding=True)
-
         for file in get_files(filter="d"):
-            full_path = os.path.join(GIT_TOP, file)
-            mime_type = m.from_file(full_path)
+            mime_type = REPO.mime(file)
 
             if not mime_type.startswith("text/"):
                 continue
 
             # format is "text/<type>; charset=<charset>"
-            if mime_type.rsplit('=')[-1] not in self.ALLOWED_CHARSETS:
+            if REPO.charset(file) not in self.ALLOWED_CHARSETS:
                 desc = f"Text file with unsupported encoding: {file} has mime type {mime_type}"
                 self.fmtd_failure("error", "TextEncoding", file, desc=desc)
 
@@ -1677,6 +4207,9 @@ def init_logs(cli_arg):
     console.setFormatter(logging.Formatter('%(levelname)-8s: %(message)s'))
 
     logger = logging.getLogger('')
+    # Replace the handler of an earlier call, e.g. by a --serve daemon
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
     logger.addHandler(console)
     logger.setLevel(cli_arg or level)
 
@@ -1719,6 +4252,334 @@ def resolve_path_hint(hint):
         return hint
 
 
+def run_test(testcase):
+    # Instantiates and runs the ComplianceTest subclass 'testcase'. Returns
+    # the test instance, which holds the JUnit TestCase, the formatted
+    # failures and the CheckProfile of the run.
+
+    test = testcase()
+    test.profile = CheckProfile()
+    try:
+        # All tests run if this script changed
+        if not RUN_ALL and CHECKER_PATH not in REPO.paths() and \
+           not testcase.inputs_changed(REPO.paths()):
+            test.skip("None of the files the test checks were changed",
+                      msg="unchanged")
+
+        if BUDGET and not BUDGET.allows(test.name):
+            test.skip("Not enough time left within --budget", msg="budget")
+
+        print(f"Running {test.name:16} tests in "
+              f"{resolve_path_hint(test.path_hint)} ...")
+        with test.profile:
+            test.run()
+    except EndTest:
+        pass
+
+    test.profile.add_properties(test.case)
+
+    return test
+
+
+class CostModel:
+    """
+    Learned run times of the tests, for --budget. The run time of a test is
+    modeled as a base cost plus a cost per changed file of each type (see
+    file_type()). The costs are fitted to the measured run times with a
+    normalized least-mean-squares update after each run, and stored as JSON
+    in 'path'.
+    """
+    # Learning rate of the update
+    RATE = 0.5
+
+    def __init__(self, path):
+        self.path = path
+        self.costs = {}
+        try:
+            with open(path) as f:
+                self.costs = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring broken cost history {path}: {e}")
+
+    @staticmethod
+    def file_type(file):
+        # Returns the type of 'file' for the cost model: "Kconfig" for
+        # Kconfig files, and the extension (or base name if it has none)
+        # otherwise
+
+        name = os.path.basename(file)
+        if "Kconfig" in name:
+            return "Kconfig"
+        return os.path.splitext(name)[1].lower() or name
+
+    @classmethod
+    def features(cls, files):
+        """
+        Returns the model inputs for the changed files 'files', as a
+        {<file type>: <count>} dict. The "" entry is always 1 and stands for
+        the base cost.
+        """
+        features = collections.Counter(map(cls.file_type, files))
+        features[""] = 1
+        return dict(features)
+
+    def predict(self, name, features):
+        """
+        Returns the predicted run time in seconds of the test 'name' for the
+        model inputs 'features', or None if the test never ran before.
+        """
+        if name not in self.costs:
+            return None
+
+        costs = self.costs[name]
+        return sum(costs.get(type_, 0) * n for type_, n in features.items())
+
+    def update(self, name, features, run_time):
+        """
+        Updates the costs of the test 'name' after it took 'run_time' seconds
+        for the inputs 'features'.
+        """
+        costs = self.costs.setdefault(name, {})
+        error = run_time - self.predict(name, features)
+        norm = sum(n * n for n in features.values())
+        for type_, n in features.items():
+            costs[type_] = round(max(0.0, costs.get(type_, 0)
+                                     + self.RATE * error * n / norm), 6)
+
+    def save(self):
+        """
+        Writes the costs to 'path'.
+        """
+        with open(self.path, "w") as f:
+            json.dump(self.costs, f, indent=4, sort_keys=True)
+
+
+class Budget:
+    """
+    Time budget for a run (--budget). A test is only started if it is
+    predicted to finish before the deadline. Tests without a predicted cost
+    are started as long as the deadline hasn't passed.
+    """
+    def __init__(self, seconds, costs):
+        # 'costs' maps test names to predicted run times in seconds
+        self.deadline = time.time() + seconds
+        self.costs = costs
+
+    def allows(self, name):
+        """
+        Returns True if the test 'name' fits into the remaining time.
+        """
+        return time.time() + (self.costs.get(name) or 0) <= self.deadline
+
+
+class JobSlots:
+    """
+    The --jobs budget, shared by the tests that run in parallel and the
+    subprocesses or worker processes that the tests run in parallel
+    themselves. Each running test holds a slot (see run_tests()), and can
+    take the idle slots for more workers with workers(). That way, no more
+    than --jobs workers are busy at a time, instead of up to --jobs squared
+    when parallel tests run pools of their own.
+    """
+    def __init__(self, n):
+        self._idle = n
+        self._cond = threading.Condition()
+
+    def _release(self, n):
+        with self._cond:
+            self._idle += n
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def hold(self):
+        """
+        Context manager that waits for an idle slot and holds it, for running
+        a test.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._idle > 0)
+            self._idle -= 1
+        try:
+            yield
+        finally:
+            self._release(1)
+
+    @contextlib.contextmanager
+    def workers(self, n):
+        """
+        Context manager for a test that wants to use up to 'n' parallel
+        workers. Takes up to n - 1 idle slots, without waiting, and returns
+        the number of workers the test may use: one for its own slot, plus
+        one per slot taken.
+        """
+        with self._cond:
+            taken = max(0, min(n - 1, self._idle))
+            self._idle -= taken
+        try:
+            yield 1 + taken
+        finally:
+            self._release(taken)
+
+
+# JobSlots for the run. Worker processes get one without idle slots, since
+# the thread that waits for them holds a slot in the main process.
+JOB_SLOTS = JobSlots(0)
+
+
+def run_tests(testcases, jobs=1):
+    """
+    Runs the ComplianceTest subclasses in 'testcases' and returns the test
+    instances, in the same order as 'testcases'.
+
+    With 'jobs' > 1, up to 'jobs' tests run at the same time in threads. Tests
+    with 'isolated' set run one after another in a single worker process, so
+    that changes they make to process-global state can't leak into other tests.
+    Each test holds a slot in JOB_SLOTS while it runs.
+    """
+    def run_in_slot(fn, arg):
+        with JOB_SLOTS.hold():
+            return fn(arg)
+
+    if jobs <= 1:
+        return [run_in_slot(run_test, testcase) for testcase in testcases]
+
+    isolated = [testcase for testcase in testcases if testcase.isolated]
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        if isolated:
+            isolated_future = executor.submit(run_in_slot, run_isolated_tests,
+                                              isolated)
+
+        futures = {testcase: executor.submit(run_in_slot, run_test, testcase)
+                   for testcase in testcases if not testcase.isolated}
+
+        tests = {testcase: future.result()
+                 for testcase, future in futures.items()}
+        if isolated:
+            tests.update(zip(isolated, isolated_future.result()))
+
+    return [tests[testcase] for testcase in testcases]
+
+
+def run_isolated_tests(testcases):
+    # Runs the tests in 'testcases' one after another in a fresh worker
+    # process and returns the test instances rebuilt from the results sent
+    # back by the worker. The worker process is spawned rather than forked,
+    # since the main process is already multi-threaded at this point. A
+    # --serve daemon reuses its worker process between runs instead, so that
+    # it keeps its warm state.
+
+    names = [testcase.name for testcase in testcases]
+    if ISOLATED_WORKER:
+        output, results = ISOLATED_WORKER.submit(
+            _run_worker_tests, names, _worker_state()).result()
+        sys.stdout.write(output)
+    else:
+        with new_isolated_worker() as executor:
+            _, results = executor.submit(_run_worker_tests, names,
+                                         _worker_state()).result()
+
+    tests = []
+    for testcase, (case_xml, fmtd_failures, profile) in zip(testcases, results):
+        test = testcase()
+        test.case = TestCase.fromstring(case_xml)
+        test.fmtd_failures = [FmtdFailure(*args) for args in fmtd_failures]
+        test.profile = CheckProfile.from_dict(profile)
+        tests.append(test)
+
+    return tests
+
+
+def new_isolated_worker():
+    # Returns a new executor with a single spawned worker process, for
+    # run_isolated_tests()
+
+    return ProcessPoolExecutor(max_workers=1,
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+# Worker process for the isolated tests of a --serve daemon, or None
+ISOLATED_WORKER = None
+
+
+def _worker_state():
+    # Returns the global state set up by _main(), for _init_worker()
+
+    return {
+        "BRIDLE_BASE": BRIDLE_BASE,
+        "ZEPHYR_BASE": ZEPHYR_BASE,
+        "GIT_TOP": GIT_TOP,
+        "COMMIT_RANGE": COMMIT_RANGE,
+        "REPO": REPO,
+        "CACHE_DIR": CACHE_DIR,
+        "INCREMENTAL": INCREMENTAL,
+        "BUDGET": BUDGET,
+        "RUN_ALL": RUN_ALL,
+        "CHECKER_PATH": CHECKER_PATH,
+        "JOBS": JOBS,
+        "loglevel": logging.getLevelName(logger.getEffectiveLevel()),
+        "serving": WARM_CACHE is not None,
+        # For a --serve daemon, these are the ones of the client
+        "environ": dict(os.environ),
+        "cwd": os.getcwd(),
+    }
+
+
+def _init_worker(state):
+    # Restores the global state of the main process from 'state' in a worker
+    # process, including the environment and working directory. A --serve
+    # daemon reuses its worker, so they have to be restored on each run for
+    # e.g. west and zephyr_module.py to find the client's workspace.
+
+    global WARM_CACHE, VERDICTS
+
+    state = dict(state)
+    os.environ.clear()
+    os.environ.update(state.pop("environ"))
+    os.chdir(state.pop("cwd"))
+    init_logs(state.pop("loglevel"))
+    if state.pop("serving") and WARM_CACHE is None:
+        WARM_CACHE = WarmCache()
+    globals().update(state)
+    VERDICTS = CACHE_DIR and VerdictCache(CACHE_DIR)
+
+
+def _run_worker_tests(names, state):
+    # Runs the tests with the names in 'names' in a worker process, with the
+    # _worker_state() 'state' of the main process. Returns an (<output>,
+    # <results>) tuple, with a (<JUnit XML>, <FmtdFailure arguments>,
+    # <profile dict>) result per test, since neither TestCase nor FmtdFailure
+    # instances can be pickled. <output> is what the tests printed when run
+    # for a --serve daemon, which passes it on to its client, and "" otherwise.
+
+    output = io.StringIO()
+    with contextlib.ExitStack() as stack:
+        if state["serving"]:
+            stack.enter_context(contextlib.redirect_stdout(output))
+            stack.enter_context(contextlib.redirect_stderr(output))
+
+        _init_worker(state)
+
+        name2testcase = {testcase.name: testcase
+                         for testcase in inheritors(ComplianceTest)}
+
+        results = []
+        for name in names:
+            test = run_test(name2testcase[name])
+            sys.stdout.flush()
+            results.append((test.case.tostring(),
+                            [(res.severity, res.title, res.file, res.line,
+                              res.col, res.desc) for res in test.fmtd_failures],
+                            test.profile.as_dict()))
+
+        KCONFIG_SESSION.close()
+        REPO.close()
+
+    return output.getvalue(), results
+
+
 def parse_args(argv):
 
     default_range = 'HEAD~1..HEAD'
@@ -1748,6 +4609,64 @@ def parse_args(argv):
                         from a previous run and combine with new results.''')
     parser.add_argument('--annotate', action="store_true",
                         help="Print GitHub Actions-compatible annotations.")
+    parser.add_argument('--cache-dir', default=None,
+                        help='''Directory for caches that are kept between
+                        runs, e.g. of the parsed Kconfig tree. Can be shared
+                        between CI jobs. Nothing is cached by default.''')
+    parser.add_argument('--incremental', action="store_true",
+                        help='''Only report Kconfig issues in the files changed
+                        in the commit range. Note that this misses e.g.
+                        references in unchanged files to symbols removed in
+                        the commit range.''')
+    parser.add_argument('--profile-json', metavar="FILE",
+                        help='''Write the time and resources used by each
+                        check to FILE, as JSON. They are also stored as
+                        properties in the JUnit output.''')
+    diff_group = parser.add_mutually_exclusive_group()
+    diff_group.add_argument('--staged', action="store_true",
+                            help='''Check the changes in the index (as with
+                            'git diff --cached') instead of a commit range,
+                            e.g. from a pre-commit hook. Only the checks that
+                            look at single files run. Files are read from the
+                            index, except by Pylint and ClangFormat, which
+                            read the working tree.''')
+    diff_group.add_argument('--worktree', action="store_true",
+                            help='''Check the uncommitted changes to tracked
+                            files in the working tree (as with 'git diff HEAD')
+                            instead of a commit range. Only the checks that
+                            look at single files run.''')
+    parser.add_argument('--all-checks', action="store_true",
+                        help='''Run all checks. By default, checks are skipped
+                        (with "unchanged" as the reason) if none of the files
+                        they check were changed in the commit range. Also
+                        makes BoardYml check all board.yml files instead of
+                        just the changed ones.''')
+    parser.add_argument('--budget', type=float, metavar="SECONDS",
+                        help='''Try to finish within SECONDS. Cheap checks that
+                        often find problems run first, and checks that are not
+                        expected to finish in time are skipped, with
+                        "budget" as the reason. Run times are learned from
+                        earlier runs, stored in the --cost-history file.''')
+    parser.add_argument('--cost-history', metavar="FILE",
+                        help='''Learn the run times of the checks in FILE, for
+                        --budget. Runs without --budget can update it as well.
+                        Default with --budget: <output>-history.json next to
+                        the JUnit output. Not written by default otherwise.''')
+    parser.add_argument('--serve', metavar="SOCKET",
+                        help='''Run as a daemon that listens on the Unix socket
+                        SOCKET and runs the checks for the clients that connect
+                        to it (see check_compliance_client.py). The daemon
+                        keeps e.g. the Kconfig tree and the parsed
+                        configuration files in memory between runs, and only
+                        loads them again when the files they come from
+                        change. Other options are taken from the client,
+                        except that --cache-dir is used when the client
+                        doesn't pass one. It exits when this script
+                        changes.''')
+    parser.add_argument('--jobs', type=int, default=1, metavar="N",
+                        help='''Run up to N checks in parallel. 0 means the
+                        number of CPUs. Default is 1 (run checks one after
+                        another).''')
 
     return parser.parse_args(argv)
 
@@ -1776,17 +4695,62 @@ def _main(args):
         os.environ['ZEPHYR_BASE'] = ZEPHYR_BASE
 
     # The absolute path of the top-level git directory. Initialize it here so
-    # that issues running Git can be reported to GitHub.
+    # that issues running Git can be reported to GitHub. Bare repositories
+    # have no working tree, so use the Git directory for them. The checks that
+    # only look at the diff and at the files read from the object store still
+    # work there.
     global GIT_TOP
-    GIT_TOP = git("rev-parse", "--show-toplevel")
+    if git("rev-parse", "--is-bare-repository") == "true":
+        GIT_TOP = git("rev-parse", "--absolute-git-dir")
+    else:
+        GIT_TOP = git("rev-parse", "--show-toplevel")
 
     # The commit range passed in --commit, e.g. "HEAD~3"
     global COMMIT_RANGE
     COMMIT_RANGE = args.commits
 
+    # Directory for persistent caches, or None
+    global CACHE_DIR
+    CACHE_DIR = args.cache_dir and os.path.abspath(args.cache_dir)
+
+    # Cached issues of per-file tests, or None
+    global VERDICTS
+    VERDICTS = CACHE_DIR and VerdictCache(CACHE_DIR)
+
+    # Only report Kconfig issues in the changed files
+    global INCREMENTAL
+    INCREMENTAL = args.incremental
+
+    # Git queries shared by all tests of this run
+    global REPO
+    if args.staged:
+        REPO = RepoSnapshot(COMMIT_RANGE, ("--cached",), tip="")
+    elif args.worktree:
+        REPO = RepoSnapshot(COMMIT_RANGE, ("HEAD",))
+    else:
+        REPO = RepoSnapshot(COMMIT_RANGE, tip=range_tip(COMMIT_RANGE))
+
+    # Time budget for the run, or None
+    global BUDGET
+    BUDGET = None
+
+    # Run tests even if none of their inputs changed
+    global RUN_ALL
+    RUN_ALL = args.all_checks
+
+    # Path of this script relative to GIT_TOP. All tests run if it changed.
+    global CHECKER_PATH
+    CHECKER_PATH = Path(os.path.relpath(os.path.realpath(__file__),
+                                        GIT_TOP)).as_posix()
+
     init_logs(args.loglevel)
 
-    logger.info(f'Running tests on commit range {COMMIT_RANGE}')
+    if args.staged:
+        logger.info('Running tests on the staged changes')
+    elif args.worktree:
+        logger.info('Running tests on the changes in the working tree')
+    else:
+        logger.info(f'Running tests on commit range {COMMIT_RANGE}')
 
     if args.list:
         for testcase in sorted(inheritors(ComplianceTest), key=lambda x: x.name):
@@ -1815,7 +4779,8 @@ def _main(args):
     included = list(map(lambda x: x.lower(), args.module))
     excluded = list(map(lambda x: x.lower(), args.exclude_module))
 
-    for testcase in inheritors(ComplianceTest):
+    testcases = []
+    for testcase in sorted(inheritors(ComplianceTest), key=lambda x: x.name):
         # "Modules" and "testcases" are the same thing. Better flags would have
         # been --tests and --exclude-tests or the like, but it's awkward to
         # change now.
@@ -1827,14 +4792,62 @@ def _main(args):
             print("Skipping " + testcase.name)
             continue
 
-        test = testcase()
-        try:
-            print(f"Running {test.name:16} tests in "
-                  f"{resolve_path_hint(test.path_hint)} ...")
-            test.run()
-        except EndTest:
-            pass
+        if (args.staged or args.worktree) and not testcase.per_file:
+            if included:
+                print(f"Skipping {testcase.name} (not a per-file check)")
+            continue
 
+        testcases.append(testcase)
+
+    # Run times of earlier runs. Only kept with --budget or --cost-history,
+    # so that plain runs don't leave files behind.
+    history_file = args.cost_history
+    if not history_file and args.budget is not None and args.output:
+        history_file = f"{os.path.splitext(args.output)[0]}-history.json"
+
+    cost_model = None
+    if history_file:
+        cost_model = CostModel(history_file)
+        features = CostModel.features(get_files())
+
+    if args.budget is not None:
+        costs = {testcase.name: cost_model.predict(testcase.name, features)
+                 if cost_model else None for testcase in testcases}
+        BUDGET = Budget(args.budget, costs)
+
+        # Run cheap tests that often find problems first, then the other
+        # tests from cheap to expensive. Tests that never ran before go last.
+        testcases.sort(key=lambda testcase: (
+            not testcase.high_signal,
+            float("inf") if costs[testcase.name] is None
+            else costs[testcase.name]))
+
+    # Number of parallel jobs
+    global JOBS
+    JOBS = args.jobs or os.cpu_count()
+
+    # Slots for the parallel jobs, shared by the tests and their own workers
+    global JOB_SLOTS
+    JOB_SLOTS = JobSlots(JOBS)
+
+    tests = run_tests(testcases, JOBS)
+    KCONFIG_SESSION.close()
+    REPO.close()
+    if VERDICTS:
+        VERDICTS.prune()
+
+    tests.sort(key=lambda test: test.name)
+
+    if cost_model:
+        for test in tests:
+            # Don't learn from tests that were skipped without running
+            if not (test.case.is_skipped and
+                    test.case.result[0].message in ("budget", "unchanged")):
+                cost_model.update(test.name, features,
+                                  test.profile.wall_time)
+        cost_model.save()
+
+    for test in tests:
         # Annotate if required
         if args.annotate:
             for res in test.fmtd_failures:
@@ -1842,6 +4855,11 @@ def _main(args):
 
         suite.add_testcase(test.case)
 
+    if args.profile_json:
+        with open(args.profile_json, "w") as f:
+            json.dump({test.name: test.profile.as_dict() for test in tests},
+                      f, indent=4)
+
     if args.output:
         xml = JUnitXml()
         xml.add_testsuite(suite)
@@ -1855,7 +4873,13 @@ def _main(args):
     for case in suite:
         if case.result:
             if case.is_skipped:
-                logging.warning(f"Skipped {case.name}")
+                reason = case.result[0].message
+                if reason in ("unchanged", "budget"):
+                    # Expected with --budget, and when checks were skipped
+                    # because none of their inputs changed
+                    logging.info(f"Skipped {case.name} ({reason})")
+                else:
+                    logging.warning(f"Skipped {case.name}")
             else:
                 failed_cases.append(case)
         else:
@@ -1884,6 +4908,149 @@ def _main(args):
     return n_fails
 
 
+class _ClientStream(io.TextIOBase):
+    # Text stream that sends what is written to it to a client of the --serve
+    # daemon. See serve() for the protocol.
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if s:
+            self.send({"output": s})
+        return len(s)
+
+    def send(self, msg):
+        """
+        Sends the message 'msg' to the client, as a JSON line. Errors are
+        ignored, so that the run is completed even if the client went away.
+        """
+        with self._lock:
+            try:
+                self._conn.sendall(json.dumps(msg).encode("utf-8") + b"\n")
+            except OSError:
+                pass
+
+
+def _serve_client(conn, request, cache_dir):
+    # Runs the checks for the client connected on 'conn', which sent
+    # 'request', and sends it the results. 'cache_dir' is used if the client
+    # didn't pass --cache-dir.
+
+    stream = _ClientStream(conn)
+
+    # Run with the working directory and environment of the client
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    os.environ.clear()
+    os.environ.update(request["env"])
+    try:
+        with contextlib.redirect_stdout(stream), \
+             contextlib.redirect_stderr(stream):
+            try:
+                os.chdir(request["cwd"])
+                args = parse_args(request["argv"])
+                if args.serve:
+                    err("--serve can't be passed by a client")
+                if args.cache_dir is None:
+                    args.cache_dir = cache_dir
+                status = _main(args)
+            except SystemExit as e:
+                # Raised by argparse and err()
+                if isinstance(e.code, str):
+                    print(e.code, file=sys.stderr)
+                    status = 1
+                else:
+                    status = e.code or 0
+            except Exception:
+                print(f"Python exception in `{__file__}`:\n\n"
+                      f"```\n{traceback.format_exc()}\n```")
+                status = 1
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+
+    stream.send({"status": status})
+
+
+def serve(args):
+    """
+    Runs the --serve daemon, which handles one client at a time.
+
+    A client sends a single JSON line with the command-line arguments
+    ("argv"), the working directory ("cwd") and the environment ("env") to run
+    the checks with. The daemon replies with JSON lines with the output of the
+    run ({"output": <text>}), followed by {"status": <exit status>}. If this
+    script changed since the daemon started, it replies with {"restart": true}
+    instead and exits, and the client is expected to run the checks itself.
+    """
+    global WARM_CACHE, ISOLATED_WORKER
+
+    path = args.serve
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            err(f"a daemon is already listening on {path}")
+        except OSError:
+            pass
+
+    # Remove a stale socket
+    if os.path.exists(path):
+        os.unlink(path)
+
+    WARM_CACHE = WarmCache()
+    ISOLATED_WORKER = new_isolated_worker()
+    cache_dir = args.cache_dir and os.path.abspath(args.cache_dir)
+    if not cache_dir:
+        cache_dir = tempfile.mkdtemp(prefix="compliance_")
+    script_stamp = WarmCache.stamp([__file__])
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        server.listen()
+        print(f"Listening on {path}")
+        sys.stdout.flush()
+
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    with conn.makefile("rb") as f:
+                        line = f.readline()
+                    if not line:
+                        # E.g. another daemon checking if this one is running
+                        continue
+                    request = json.loads(line)
+                except (OSError, ValueError) as e:
+                    print(f"Invalid request: {e}")
+                    continue
+
+                if WarmCache.stamp([__file__]) != script_stamp:
+                    _ClientStream(conn).send({"restart": True})
+                    print(f"{__file__} changed, exiting")
+                    break
+
+                _serve_client(conn, request, cache_dir)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+        ISOLATED_WORKER.shutdown()
+        if PYLINT_POOL:
+            PYLINT_POOL[1].shutdown()
+        if not args.cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
 def main(argv=None):
     args = parse_args(argv)
 
@@ -1895,6 +5062,10 @@ def main(argv=None):
         print("See https://github.com/weiwei/junitparser/issues/99")
         return 1
 
+    if args.serve:
+        serve(args)
+        return 0
+
     try:
         n_fails = _main(args)
     except BaseException:
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2025 TiaC Systems
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Thin client for the check_compliance.py --serve daemon, e.g. for use in a Git
+pre-push hook:
+
+    check_compliance_client.py --socket SOCKET [check_compliance.py options]
+
+The options are passed on to the daemon, which runs the checks in the current
+directory and with the current environment. The output and exit status are
+the ones of check_compliance.py. If no daemon listens on SOCKET, or if it
+needs to be restarted, check_compliance.py is run directly instead.
+
+Only the standard library is imported, so that starting the client is cheap.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+
+CHECK_COMPLIANCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "check_compliance.py")
+
+
+def run_remote(path, argv):
+    # Runs the checks on the daemon listening on the Unix socket 'path'.
+    # Returns the exit status, or None if the checks have to be run locally.
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return None
+
+        request = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}
+        try:
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        except OSError:
+            return None
+
+        with sock.makefile("rb") as f:
+            for line in f:
+                msg = json.loads(line)
+                if "output" in msg:
+                    sys.stdout.write(msg["output"])
+                    sys.stdout.flush()
+                elif "status" in msg:
+                    return msg["status"]
+                elif msg.get("restart"):
+                    return None
+
+    sys.exit("error: the check_compliance.py daemon closed the connection")
+
+
+def main(argv):
+    if len(argv) < 2 or argv[0] != "--socket":
+        sys.exit(f"usage: {sys.argv[0]} --socket SOCKET "
+                 "[check_compliance.py options]")
+    path, argv = argv[1], argv[2:]
+
+    status = run_remote(path, argv)
+    if status is None:
+        status = subprocess.run([sys.executable, CHECK_COMPLIANCE, *argv],
+                                check=False).returncode
+
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
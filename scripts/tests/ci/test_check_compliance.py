@@ -0,0 +1,709 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024 TiaC Systems
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Tests for scripts/ci/check_compliance.py
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+CI_DIR = Path(__file__).resolve().parents[2] / "ci"
+sys.path.insert(0, str(CI_DIR))
+
+import check_compliance  # noqa: E402
+
+
+def git(repo, *args):
+    return subprocess.run(("git", *args), cwd=repo, check=True,
+                          capture_output=True, text=True).stdout.strip()
+
+
+def commit(repo, files, message="Change"):
+    # Writes the {<path>: <contents or ("link", <target>)>} 'files' in 'repo'
+    # and commits them
+    for path, contents in files.items():
+        full_path = repo / path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        if full_path.is_symlink():
+            full_path.unlink()
+        if isinstance(contents, tuple):
+            os.symlink(contents[1], full_path)
+        else:
+            full_path.write_text(contents)
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", message)
+    return git(repo, "rev-parse", "HEAD")
+
+
+@pytest.fixture(autouse=True)
+def logger(monkeypatch):
+    # The logger is set up by main()
+    monkeypatch.setattr(check_compliance, "logger",
+                        logging.getLogger("check_compliance"), raising=False)
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    git(repo, "init", "-q")
+    git(repo, "config", "user.name", "Test")
+    git(repo, "config", "user.email", "test@example.com")
+    commit(repo, {"README": "Test repository\n"}, "Initial commit")
+
+    # Minimal Zephyr tree
+    zephyr_bindings = tmp_path / "zephyr" / "dts" / "bindings"
+    zephyr_bindings.mkdir(parents=True)
+    (zephyr_bindings / "vendor-prefixes.txt").write_text("zephyr\tZephyr\n")
+
+    monkeypatch.chdir(repo)
+    monkeypatch.setattr(check_compliance, "GIT_TOP", str(repo), raising=False)
+    return repo
+
+
+def run_checks(repo, *args):
+    # Runs check_compliance.py in 'repo' and returns the completed process.
+    # The JUnit output is written to 'repo'/../compliance.xml.
+    env = dict(os.environ, BRIDLE_BASE=str(repo),
+               ZEPHYR_BASE=str(repo.parent / "zephyr"))
+    return subprocess.run(
+        (sys.executable, str(CI_DIR / "check_compliance.py"), "-n",
+         "-o", str(repo.parent / "compliance.xml"), *args),
+        cwd=repo, env=env, capture_output=True, text=True)
+
+
+@pytest.mark.parametrize("tip", ["HEAD", "", None],
+                         ids=["commit", "index", "worktree"])
+def test_snapshot_follows_symlinks(repo, tip):
+    commit(repo, {"a.txt": "int a;\n",
+                  "link.h": ("link", "a.txt"),
+                  "dir/up.h": ("link", "../link.h"),
+                  "dangling.h": ("link", "missing.h"),
+                  "outside.h": ("link", "../outside.h"),
+                  "loop.h": ("link", "loop.h")})
+    if tip == "HEAD":
+        tip = git(repo, "rev-parse", "HEAD")
+
+    snapshot = check_compliance.RepoSnapshot("HEAD~..", tip=tip)
+    assert sorted(snapshot.files()) == ["a.txt", "dir/up.h", "link.h"]
+    for file in ("link.h", "dir/up.h"):
+        assert snapshot.isfile(file)
+        assert snapshot.read(file) == b"int a;\n"
+        assert snapshot.blob_id(file) == snapshot.blob_id("a.txt")
+    for file in ("dangling.h", "loop.h", "dir", "nope.h"):
+        assert not snapshot.isfile(file)
+        with pytest.raises(OSError):
+            snapshot.read(file)
+    snapshot.close()
+
+
+def test_symlink_checked_as_its_target(repo):
+    # The link itself has no trailing newline, but the file it points to
+    # does
+    commit(repo, {"a.txt": "int a;\n", "link.h": ("link", "a.txt")})
+
+    cp = run_checks(repo, "-c", "HEAD~..", "-m", "Nits")
+    assert cp.returncode == 0, cp.stdout + cp.stderr
+
+
+def test_board_yml_vendor_prefixes_from_snapshot(repo):
+    commit(repo, {
+        "zephyr/module.yml": "build:\n  settings:\n    board_root: .\n",
+        "dts/bindings/vendor-prefixes.txt": "acme\tAcme Corp.\n",
+        "boards/acme/foo/board.yml": "board:\n  name: foo\n  vendor: acme\n",
+    })
+    # Uncommitted changes don't affect the checked commits
+    (repo / "dts" / "bindings" / "vendor-prefixes.txt").write_text("")
+
+    cp = run_checks(repo, "-c", "HEAD~..", "-m", "BoardYml")
+    assert cp.returncode == 0, cp.stdout + cp.stderr
+
+    git(repo, "checkout", "--", ".")
+    commit(repo, {"boards/acme/foo/board.yml":
+                  "board:\n  name: foo\n  vendor: nobody\n"})
+
+    cp = run_checks(repo, "-c", "HEAD~..", "-m", "BoardYml")
+    assert cp.returncode == 1
+    assert "invalid vendor: nobody" in cp.stderr
+
+
+def test_checkpatch_split_batches():
+    chunks = [b"a" * 10, b"b" * 10, b"c" * 30, b"d" * 10]
+    split = check_compliance.CheckPatch.split_batches
+
+    assert split(chunks, 1) == [chunks]
+    assert split(chunks, 2) == [chunks[:2], chunks[2:]]
+    # Batches keep the diff order, and empty batches are dropped
+    assert split(chunks[:1], 4) == [chunks[:1]]
+    assert sum(split(chunks, 3), []) == chunks
+
+
+def test_checkpatch_issue_without_file_line(repo):
+    # Issues without a FILE: line are reported for the file whose diff
+    # contains the line of the input they refer to
+    batch = [b"diff --git a/x.c b/x.c\n+x\n",
+             b"diff --git a/y.c b/y.c\n+y\n+y\n"]
+    fake_checkpatch = (sys.executable, "-c", """
+import sys
+import threading
+import time
+sys.stdin.read()
+print("-:2: WARNING:X: in x.c")
+print("-:4: ERROR:Y: in y.c")
+print("#4: FILE: y.c:2:")
+print("-:5: CHECK:Z: in y.c")
+sys.exit(1)
+""")
+
+    issues, output, _ = check_compliance.CheckPatch().check_batch(
+        fake_checkpatch, batch)
+    assert issues == [("warning", "X", "x.c", None, "in x.c"),
+                      ("error", "Y", "y.c", 2, "in y.c"),
+                      ("notice", "Z", "y.c", None, "in y.c")]
+    assert output is None
+
+
+def test_add_sys_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "path", list(sys.path))
+    path = str(tmp_path)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(check_compliance.add_sys_path, [path] * 64))
+    assert sys.path[0] == path
+    assert sys.path.count(path) == 1
+
+
+@pytest.fixture
+def snapshot(repo, monkeypatch):
+    # Returns a function that makes the commit range 'commit_range' in 'repo'
+    # the one the checks look at
+
+    def snapshot(commit_range):
+        repo_snapshot = check_compliance.RepoSnapshot(
+            commit_range, tip=check_compliance.range_tip(commit_range))
+        monkeypatch.setattr(check_compliance, "REPO", repo_snapshot,
+                            raising=False)
+        return repo_snapshot
+
+    return snapshot
+
+
+def sphinx_lint_results():
+    test = check_compliance.SphinxLint()
+    try:
+        test.run()
+    except check_compliance.EndTest:
+        pass
+    return [(res.type, res.message) for res in test.case.result]
+
+
+def test_sphinx_lint_cli_fallback(repo, snapshot, monkeypatch):
+    pytest.importorskip("sphinxlint")
+    commit(repo, {"doc/a.rst": "Title\n=====\n\nA `default role` \n",
+                  "doc/b.rst": "Fine\n====\n"})
+    snapshot("HEAD~..")
+
+    in_process = sphinx_lint_results()
+    assert in_process
+    assert all(message.startswith("doc/a.rst:4 ")
+               for _, message in in_process)
+
+    # Versions without the internals that are used in-process
+    monkeypatch.setattr(check_compliance.SphinxLint, "load_api",
+                        staticmethod(lambda: None))
+    assert sorted(sphinx_lint_results()) == sorted(in_process)
+
+
+def test_sphinx_lint_incompatible_api(repo, snapshot, monkeypatch):
+    commit(repo, {"doc/a.rst": "Title\n=====\n"})
+    snapshot("HEAD~..")
+
+    def check_text(filename, text, checkers):
+        raise TypeError("unexpected argument")
+
+    monkeypatch.setattr(check_compliance.SphinxLint, "load_api",
+                        staticmethod(lambda: (check_text, set(), [])))
+    assert sphinx_lint_results() == [("failure", "incompatible sphinx-lint")]
+
+
+def test_unchanged_checks_skipped_quietly(repo):
+    commit(repo, {"README": "Changed\n"})
+
+    cp = run_checks(repo, "-c", "HEAD~..", "-m", "Nits", "-m", "Pylint")
+    assert cp.returncode == 0, cp.stdout + cp.stderr
+    assert "Skipped" not in cp.stderr
+
+    cp = run_checks(repo, "-c", "HEAD~..", "-m", "Nits", "-m", "Pylint",
+                    "-v", "INFO")
+    assert "INFO    : Skipped Pylint (unchanged)" in cp.stderr
+
+
+def test_verdict_cache_key():
+    key = check_compliance.VerdictCache.key
+    parts = ("Nits", "config", "a.c", "1" * 40)
+
+    assert key(*parts) == key(*parts)
+    # Each part is part of the key, and parts can't run into each other
+    for i in range(len(parts)):
+        changed = list(parts)
+        changed[i] += "x"
+        assert key(*changed) != key(*parts)
+    assert key("ab", "c") != key("a", "bc")
+
+
+def test_verdict_cache_prune(tmp_path, monkeypatch):
+    cache = check_compliance.VerdictCache(str(tmp_path))
+    key = cache.key
+
+    assert cache.get(key("a")) is None
+    cache.put(key("a"), [["failure", ["text", None, "failure"]]])
+    assert cache.get(key("a")) == [["failure", ["text", None, "failure"]]]
+
+    for i, name in enumerate("bcd"):
+        cache.put(key(name), "x" * 100)
+        os.utime(cache._path(key(name)), (i, i))
+    # Using a verdict makes it the most recently used one
+    os.utime(cache._path(key("a")), (0, 0))
+    cache.get(key("b"))
+
+    monkeypatch.setattr(cache, "MAX_SIZE", 250)
+    cache.prune()
+    assert cache.get(key("a")) is None
+    assert cache.get(key("c")) is None
+    assert cache.get(key("d")) == cache.get(key("b")) == "x" * 100
+
+
+def test_cached_check(repo, snapshot, tmp_path, monkeypatch):
+    commit(repo, {"a.c": "int a;\n", "b.c": "int a;\n", "c.c": "int c;\n"})
+    snapshot("HEAD~..")
+    monkeypatch.setattr(check_compliance, "VERDICTS",
+                        check_compliance.VerdictCache(str(tmp_path / "cache")))
+    checked = []
+
+    def run(file, config="config", cache=True):
+        test = check_compliance.Nits()
+
+        def check():
+            checked.append(file)
+            test.fmtd_failure("error", "Nit", file, 1)
+            test.failure("text", "msg")
+            return cache
+
+        test.cached_check(file, config, check)
+        return [(res.type, res.message) for res in test.case.result]
+
+    results = run("a.c")
+    assert run("a.c") == results
+    assert checked == ["a.c"]
+
+    # Same contents, but another path or configuration
+    run("b.c")
+    run("a.c", "other")
+    assert checked == ["a.c", "b.c", "a.c"]
+
+    # Verdicts that check() asks not to cache
+    run("c.c", cache=False)
+    run("c.c")
+    assert checked == ["a.c", "b.c", "a.c", "c.c", "c.c"]
+
+    # Changed contents
+    commit(repo, {"a.c": "int b;\n"})
+    snapshot("HEAD~..")
+    run("a.c")
+    assert checked[-1] == "a.c" and len(checked) == 6
+
+
+def test_kconfig_cache_keys(tmp_path, monkeypatch):
+    monkeypatch.setattr(check_compliance, "ZEPHYR_BASE",
+                        str(tmp_path / "zephyr"), raising=False)
+    modules = "modules"
+    monkeypatch.setattr(check_compliance, "west_modules_digest",
+                        lambda: modules)
+
+    def cache(filename="Kconfig", no_modules=False):
+        cache = check_compliance.KconfigCache(str(tmp_path), filename,
+                                              no_modules)
+        return cache.generated_dir, cache.tree_file
+
+    generated_dir, tree_file = cache()
+    assert cache() == (generated_dir, tree_file)
+
+    # The generated files only depend on the module setup
+    other_generated_dir, other_tree_file = cache("Kconfig.other")
+    assert other_generated_dir == generated_dir
+    assert other_tree_file != tree_file
+
+    assert set(cache(no_modules=True)).isdisjoint({generated_dir, tree_file})
+
+    modules = "changed"
+    assert set(cache()).isdisjoint({generated_dir, tree_file})
+
+    # Without a west workspace, only the variant without modules is cached
+    modules = None
+    assert not check_compliance.KconfigCache(str(tmp_path), "Kconfig",
+                                             False).enabled
+    assert check_compliance.KconfigCache(str(tmp_path), "Kconfig",
+                                         True).enabled
+
+
+def test_kconfig_cache_generated_valid(repo, tmp_path, monkeypatch):
+    monkeypatch.setattr(check_compliance, "ZEPHYR_BASE",
+                        str(tmp_path / "zephyr"), raising=False)
+    commit(repo, {"boards/acme/foo/board.yml": "board:\n  name: foo\n"})
+    cache = check_compliance.KconfigCache(str(tmp_path / "cache"), "Kconfig",
+                                          True)
+
+    assert not cache.generated_valid()
+    cache.prepare_generated()
+    cache.store_generated([str(repo)])
+    assert cache.generated_valid()
+
+    # Changes to files the generators don't read
+    (repo / "README").write_text("Changed\n")
+    assert cache.generated_valid()
+
+    # Uncommitted, committed and added board files
+    (repo / "boards/acme/foo/board.yml").write_text("board:\n  name: bar\n")
+    assert not cache.generated_valid()
+    git(repo, "checkout", "--", ".")
+    assert cache.generated_valid()
+    commit(repo, {"boards/acme/foo/board.yml": "board:\n  name: bar\n"})
+    assert not cache.generated_valid()
+
+    cache.prepare_generated()
+    cache.store_generated([str(repo)])
+    (repo / "boards/acme/baz").mkdir()
+    (repo / "boards/acme/baz/board.yml").write_text("board:\n  name: baz\n")
+    assert not cache.generated_valid()
+
+
+def test_range_tip(repo):
+    commits = [commit(repo, {"a.txt": f"{i}\n"}) for i in range(3)]
+
+    for commit_range, tip in (("HEAD~2..", commits[2]),
+                              ("HEAD~2..HEAD~", commits[1]),
+                              ("HEAD~2...HEAD~", commits[1]),
+                              ("HEAD~", commits[1]),
+                              (f"{commits[0]}..{commits[1]}", commits[1])):
+        assert check_compliance.range_tip(commit_range) == tip, commit_range
+
+
+@pytest.mark.parametrize("mode", ["range", "staged", "worktree"])
+def test_snapshot_modes(repo, mode):
+    commit(repo, {"committed.c": "int a;\n", "changed.c": "int a;\n"})
+    (repo / "staged.c").write_text("int a;\n")
+    (repo / "changed.c").write_text("int a;\nint b;\n")
+    git(repo, "add", "staged.c", "changed.c")
+    (repo / "changed.c").write_text("int a;\nint b;\nint c;\n")
+    (repo / "worktree.c").write_text("int a;\n")
+    git(repo, "add", "-N", "worktree.c")
+
+    if mode == "staged":
+        snapshot = check_compliance.RepoSnapshot("HEAD~..", ("--cached",),
+                                                 tip="")
+        files, contents = ["changed.c", "staged.c"], "int a;\nint b;\n"
+    elif mode == "worktree":
+        snapshot = check_compliance.RepoSnapshot("HEAD~..", ("HEAD",))
+        files, contents = ["changed.c", "staged.c", "worktree.c"], \
+            "int a;\nint b;\nint c;\n"
+    else:
+        snapshot = check_compliance.RepoSnapshot(
+            "HEAD~..", tip=check_compliance.range_tip("HEAD~.."))
+        files, contents = ["changed.c", "committed.c"], "int a;\n"
+
+    assert sorted(snapshot.files()) == files
+    assert snapshot.text("changed.c") == contents
+    assert snapshot.blob_id("changed.c") == \
+        check_compliance.git_blob_id(contents.encode())
+    # Commits are always taken from the commit range
+    assert snapshot.shas() == [git(repo, "rev-parse", "HEAD")]
+    snapshot.close()
+
+
+def test_staged_and_worktree_checks(repo):
+    commit(repo, {"a.c": "int a;\n"})
+    # The staged version lacks a newline at the end, the working tree one
+    # doesn't
+    (repo / "a.c").write_text("int a;")
+    git(repo, "add", "a.c")
+    (repo / "a.c").write_text("int a;\n")
+
+    assert run_checks(repo, "-c", "HEAD~..", "-m", "Nits").returncode == 0
+    cp = run_checks(repo, "--staged", "-m", "Nits")
+    assert cp.returncode == 1
+    assert "Missing newline at end of 'a.c'" in cp.stdout + cp.stderr
+    assert run_checks(repo, "--worktree", "-m", "Nits").returncode == 0
+
+    # Checks that look at more than the changed files don't run
+    cp = run_checks(repo, "--staged", "-m", "Nits", "-m", "Identity")
+    assert "Skipping Identity (not a per-file check)" in cp.stdout
+
+
+@pytest.fixture
+def daemon(repo, tmp_path):
+    # Returns a function that starts a --serve daemon of the check_compliance.py
+    # script 'script' and returns its socket and process. The daemons are
+    # stopped at the end of the test.
+    daemons = []
+
+    def daemon(script=CI_DIR / "check_compliance.py"):
+        sock = tmp_path / f"daemon{len(daemons)}.sock"
+        proc = subprocess.Popen(
+            (sys.executable, str(script), "--serve", str(sock)),
+            cwd=repo, stdout=subprocess.PIPE, text=True)
+        daemons.append(proc)
+        assert proc.stdout.readline() == f"Listening on {sock}\n"
+        return sock, proc
+
+    yield daemon
+
+    for proc in daemons:
+        proc.send_signal(signal.SIGINT)
+        proc.wait(timeout=30)
+        proc.stdout.close()
+
+
+def run_client(repo, sock, *args, client=CI_DIR / "check_compliance_client.py"):
+    # Runs the --serve client 'client' in 'repo', like run_checks()
+    env = dict(os.environ, BRIDLE_BASE=str(repo),
+               ZEPHYR_BASE=str(repo.parent / "zephyr"))
+    return subprocess.run(
+        (sys.executable, str(client), "--socket", str(sock), "-n",
+         "-o", str(repo.parent / "compliance.xml"), *args),
+        cwd=repo, env=env, capture_output=True, text=True)
+
+
+def test_daemon_round_trip(repo, daemon):
+    commit(repo, {"a.c": "int a;"})
+    sock, _ = daemon()
+
+    cp = run_client(repo, sock, "-c", "HEAD~..", "-m", "Nits")
+    assert cp.returncode == 1
+    assert "Missing newline at end of 'a.c'" in cp.stdout
+
+    # Each run uses the working directory and environment of the client
+    commit(repo, {"a.c": "int a;\n"})
+    cp = run_client(repo, sock, "-c", "HEAD~..", "-m", "Nits")
+    assert cp.returncode == 0, cp.stdout
+    assert run_client(repo, sock, "-c", "HEAD~2..", "-m", "Nits",
+                      "-m", "Identity").returncode == \
+        run_checks(repo, "-c", "HEAD~2..", "-m", "Nits",
+                   "-m", "Identity").returncode
+
+    cp = run_client(repo, sock, "--no-such-option")
+    assert cp.returncode == 2
+    assert "unrecognized arguments: --no-such-option" in cp.stdout
+
+
+def test_client_fallback(repo, daemon, tmp_path):
+    commit(repo, {"a.c": "int a;"})
+
+    # No daemon listening
+    cp = run_client(repo, tmp_path / "none.sock", "-c", "HEAD~..", "-m", "Nits")
+    assert cp.returncode == 1
+    assert "Missing newline at end of 'a.c'" in cp.stdout + cp.stderr
+
+    # The daemon asks the client to run the checks itself when the script
+    # changed since it started, and exits
+    scripts = tmp_path / "scripts"
+    scripts.mkdir()
+    for script in ("check_compliance.py", "check_compliance_client.py"):
+        shutil.copy(CI_DIR / script, scripts)
+    sock, proc = daemon(scripts / "check_compliance.py")
+    with open(scripts / "check_compliance.py", "a") as f:
+        f.write("\n# Changed\n")
+
+    cp = run_client(repo, sock, "-c", "HEAD~..", "-m", "Nits",
+                    client=scripts / "check_compliance_client.py")
+    assert cp.returncode == 1
+    assert "Missing newline at end of 'a.c'" in cp.stdout + cp.stderr
+    assert proc.wait(timeout=30) == 0
+    assert not sock.exists()
+
+
+# 1x1 PNG image
+PNG = bytes.fromhex("89504e470d0a1a0a0000000d49484452000000010000000108060000"
+                    "001f15c4890000000d49444154789c63f8ffff3f0005fe02fea7d6a4"
+                    "8a0000000049454e44ae426082")
+
+
+@pytest.mark.parametrize("data, mime_type", [
+    (b"", "application/x-empty; charset=binary"),
+    (b"int a;\n", "text/plain; charset=us-ascii"),
+    ("/* é */\n".encode(), "text/plain; charset=utf-8"),
+    (b"#!/usr/bin/env python3\n", "text/x-python; charset=us-ascii"),
+    (PNG, "image/png; charset=binary"),
+    (b"GIF89a\1\0\1\0", "image/gif; charset=binary"),
+    (b"RIFF\0\0\0\0WEBPVP8 ", "image/webp; charset=binary"),
+    # Left to libmagic
+    (b"<svg/>\n", None),
+    (b"\x7fELF\2\1\1\0", None),
+    ("é\n".encode("latin-1"), None),
+])
+def test_sniff_mime(data, mime_type):
+    assert check_compliance.sniff_mime(data) == mime_type
+
+
+@pytest.mark.parametrize("data", [
+    b"int a;\n", "/* é */\n".encode(), b"#!/usr/bin/env python3\n",
+    b"#!/bin/sh\n", b"  \n", PNG, b"GIF89a\1\0\1\0",
+])
+def test_sniff_mime_agrees_with_libmagic(data):
+    # The checks look at the charset and at whether files are text, images or
+    # Python scripts, which must be the same as with libmagic
+    magic = pytest.importorskip("magic")
+
+    def properties(mime_type):
+        mime_type, charset = mime_type.split("; charset=")
+        return mime_type.split("/")[0], "python" in mime_type, charset
+
+    assert properties(check_compliance.sniff_mime(data)) == \
+        properties(magic.Magic(mime=True, mime_encoding=True).from_buffer(data))
+
+
+def test_cost_model(tmp_path):
+    path = tmp_path / "costs.json"
+    model = check_compliance.CostModel(str(path))
+    features = model.features
+
+    assert features(["a.c", "b.C", "Kconfig.board", "Makefile"]) == \
+        {"": 1, ".c": 2, "Kconfig": 1, "Makefile": 1}
+    assert model.predict("Test", features([])) is None
+
+    # Run times of 1 s plus 0.5 s per C file are learned
+    for _ in range(50):
+        for n in range(4):
+            files = [f"{i}.c" for i in range(n)]
+            model.update("Test", features(files), 1 + 0.5 * n)
+    assert model.predict("Test", features(["a.c"] * 10)) == \
+        pytest.approx(6, abs=0.01)
+    # Unseen file types add nothing
+    assert model.predict("Test", features(["a.py"])) == \
+        pytest.approx(1, abs=0.01)
+
+    model.save()
+    loaded = check_compliance.CostModel(str(path))
+    assert loaded.costs == model.costs
+
+    path.write_text("{")
+    assert check_compliance.CostModel(str(path)).costs == {}
+
+
+def test_budget():
+    budget = check_compliance.Budget(10, {"Fast": 1, "Slow": 60, "New": None})
+
+    assert budget.allows("Fast")
+    assert not budget.allows("Slow")
+    # Tests without a predicted cost run until the deadline
+    assert budget.allows("New")
+    assert budget.allows("Unknown")
+    budget.deadline -= 11
+    assert not budget.allows("Unknown")
+
+
+def test_blob_reader(repo):
+    commit(repo, {"a.bin": "a\0b\n" * 1000, "b.txt": ""})
+    reader = check_compliance.BlobReader(str(repo))
+    read = reader.read
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(read, ["HEAD:a.bin", "HEAD:b.txt"] * 8))
+    assert results == [("blob", b"a\0b\n" * 1000), ("blob", b"")] * 8
+
+    assert read("HEAD:missing") is None
+    assert read("HEAD")[0] == "commit"
+
+    # Reading again after close() starts a new 'git cat-file' process
+    reader.close()
+    assert read("HEAD~:README") == ("blob", b"Test repository\n")
+    reader.close()
+
+
+def test_lru_cache():
+    cache = check_compliance.LRUCache(10)
+    cache["a"] = "aaaa"
+    cache["b"] = "bbbb"
+    assert cache["a"] == "aaaa"
+
+    # "b" is the least recently used entry
+    cache["c"] = "cccc"
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+
+    # Replacing an entry frees its old size, and values larger than the
+    # cache aren't cached
+    cache["a"] = "a"
+    cache["d"] = "dddd"
+    assert all(key in cache for key in "acd")
+    cache["e"] = "e" * 11
+    assert "e" not in cache
+    cache["a"] = "a" * 11
+    assert "a" not in cache
+
+
+def test_profile_git_log(repo, snapshot):
+    for i in range(3):
+        commit(repo, {"a.txt": f"{i}\n"})
+    snapshot("HEAD~3..")
+
+    with check_compliance.CheckProfile() as profile:
+        assert len(check_compliance.REPO.commits()) == 3
+    assert profile.subprocesses == 1
+    assert 0 < profile.subprocess_time <= profile.wall_time
+
+
+def test_job_slots():
+    slots = check_compliance.JobSlots(4)
+    busy = []
+    lock = threading.Lock()
+
+    def test(n):
+        # A test that runs a pool of up to 'n' workers
+        with slots.hold(), slots.workers(n) as workers:
+            with lock:
+                busy.append(workers)
+                assert sum(busy) <= 4
+            time.sleep(0.01)
+            with lock:
+                busy.remove(workers)
+            return workers
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(test, [1, 8, 3, 8, 2, 1, 8, 4] * 4))
+    assert all(1 <= workers <= 4 for workers in results)
+
+    # All slots are idle again
+    with slots.hold(), slots.workers(8) as workers:
+        assert workers == 4
+
+
+def test_jobs_results(repo):
+    # The results are the same when tests run in parallel
+    commit(repo, {"a.c": "int a; \n", "b.py": "import os\n", "c.txt": "c"})
+
+    def results(jobs):
+        cp = run_checks(repo, "-c", "HEAD~..", "--jobs", jobs,
+                        *(arg for module in ("Nits", "Pylint", "GitDiffCheck",
+                                             "TextEncoding", "Identity")
+                          for arg in ("-m", module)))
+        assert "Complete results" in cp.stdout, cp.stdout + cp.stderr
+        xml = (repo.parent / "compliance.xml").read_text()
+        return cp.returncode, sorted(re.findall(r'message="[^"]*"', xml))
+
+    single = results("1")
+    assert single[0] == 4
+    assert results("4") == single